@@ -44,14 +44,17 @@ if __name__ == '__main__':
             import eventlet
             eventlet.monkey_patch()
 
-import base64, cgi, email.utils, functools, hmac, imp, itertools, mimetypes,\
+import base64, email.utils, functools, hmac, itertools, mimetypes,\
         os, re, sys, tempfile, threading, time, warnings
 
-from types import FunctionType
+from types import FunctionType, ModuleType
 from datetime import date as datedate, datetime, timedelta
 from tempfile import TemporaryFile
 from traceback import format_exc, print_exc
-from inspect import getargspec
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # 2.x
+    from inspect import getargspec
 from unicodedata import normalize
 
 try:
@@ -98,7 +101,7 @@ if py3k:
     from urllib.parse import urlencode, quote as urlquote, unquote as urlunquote
     urlunquote = functools.partial(urlunquote, encoding='latin1')
     from http.cookies import SimpleCookie
-    from collections import MutableMapping as DictMixin
+    from collections.abc import MutableMapping as DictMixin
     import pickle
     from io import BytesIO
     from configparser import ConfigParser
@@ -1267,6 +1270,7 @@ class BaseRequest(object):
                 post[key] = value
             return post
 
+        import cgi  # Gone from Python 3.13, hfs parses uploads itself and never gets here
         safe_env = {'QUERY_STRING': ''}  # Build a safe environment for cgi
         for key in ('REQUEST_METHOD', 'CONTENT_TYPE', 'CONTENT_LENGTH'):
             if key in self.environ: safe_env[key] = self.environ[key]
@@ -1860,7 +1864,7 @@ class _ImportRedirect(object):
         """ Create a virtual package that redirects imports (see PEP 302). """
         self.name = name
         self.impmask = impmask
-        self.module = sys.modules.setdefault(name, imp.new_module(name))
+        self.module = sys.modules.setdefault(name, ModuleType(name))
         self.module.__dict__.update({
             '__file__': __file__,
             '__path__': [],
@@ -3545,7 +3549,7 @@ class StplParser(object):
     # This huge pile of voodoo magic splits python code into 8 different tokens.
     # We use the verbose (?x) regex mode to make this more manageable
 
-    _re_tok = _re_inl = r'''((?mx)         # verbose and dot-matches-newline mode
+    _re_tok = _re_inl = r'''(         # verbose and dot-matches-newline mode
         [urbURB]*
         (?:  ''(?!')
             |""(?!")
@@ -3586,6 +3590,9 @@ class StplParser(object):
     _re_split = r'''(?m)^[ \t]*(\\?)((%(line_start)s)|(%(block_start)s))'''
     # Match inline statements (may contain python strings)
     _re_inl = r'''%%(inline_start)s((?:%s|[^'"\n]+?)*?)%%(inline_end)s''' % _re_inl
+    # Global flags have to lead the whole pattern since Python 3.11
+    _re_tok = '(?mx)' + _re_tok
+    _re_inl = '(?mx)' + _re_inl
 
     default_syntax = '<% %> % {{ }}'
 
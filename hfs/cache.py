@@ -0,0 +1,224 @@
+import itertools
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from hfs import inotify
+
+# Rough per-entry footprint of a cached FileItem with its DirEntry and stat_result
+FITEM_SIZE = 512
+
+# A streamed value is kept only up to this share of the budget, holding a
+# bigger one until it is complete would cost what streaming saves
+STREAM_SHARE = 16
+
+# Stamps kept for directories that are not cached any more
+STAMP_SLACK = 1024
+
+
+def sizeof(value):
+    if isinstance(value, (str, bytes)):
+        return len(value) + 64
+
+    if isinstance(value, (list, tuple)):
+        return sum(FITEM_SIZE + 2 * len(getattr(x, 'fpath', '')) for x in value)
+
+    return FITEM_SIZE
+
+
+def dir_version(dpath):
+    st = os.stat(dpath)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+
+class Record:
+    __slots__ = ('version', 'value', 'size', 'expires')
+
+    def __init__(self, version, value, size, expires):
+        self.version = version
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class ListingCache:
+    # Values derived from one directory (scanned entries, rendered listings),
+    # valid while the directory keeps its identity and mtime. inotify, where
+    # available, also catches changes that do not touch the directory mtime.
+    def __init__(self, budget, ttl):
+        self.budget = budget
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.records = OrderedDict()
+        self.keys = {}
+        self.scanning = {}
+        self.generations = {}
+        self.used = 0
+        # Renewed on every change seen to a directory. Directories without
+        # one share floor, which moves on whenever a stamp is dropped, so
+        # that no stamp is handed out twice for one version
+        self.boot = time.time_ns()
+        self.counter = itertools.count()
+        self.floor = next(self.counter)
+        self.stamps = OrderedDict()
+        self.watcher = inotify.watcher(self.on_event)
+
+    def get(self, dpath, key, build):
+        hit, value = self.lookup(dpath, key)
+        if hit:
+            return value
+
+        ticket = value
+        try:
+            value = build()
+            self.store(ticket, value)
+        finally:
+            self.release(ticket)
+
+        return value
+
+    def get_chunks(self, dpath, key, chunks):
+        # Like get(), for a str produced by the iterator chunks: returns the
+        # cached str, or an iterator passing the chunks on as they come and
+        # keeping them joined once complete
+        hit, value = self.lookup(dpath, key)
+        if hit:
+            return value
+
+        return self.collect(value, chunks)
+
+    def collect(self, ticket, chunks):
+        kept = []
+        size = 0
+        try:
+            for chunk in chunks:
+                if kept is not None:
+                    size += len(chunk)
+                    if size > self.budget // STREAM_SHARE:
+                        kept = None
+                    else:
+                        kept.append(chunk)
+
+                yield chunk
+
+            if kept is not None:
+                self.store(ticket, ''.join(kept))
+        finally:
+            self.release(ticket)
+
+    def lookup(self, dpath, key):
+        # (True, value) on a hit, (False, ticket) on a miss; the ticket goes to
+        # store() with the built value, and to release() in any case
+        dpath = os.path.normpath(dpath)
+        try:
+            version = dir_version(dpath)
+        except OSError:
+            return False, None
+
+        with self.lock:
+            record = self.records.get((dpath, key))
+            if record is not None:
+                if record.version == version and time.monotonic() < record.expires:
+                    self.records.move_to_end((dpath, key))
+                    return True, record.value
+
+                self.discard(dpath, key)
+
+            self.scanning[dpath] = self.scanning.get(dpath, 0) + 1
+            generation = self.generations.setdefault(dpath, 0)
+
+        return False, (dpath, key, version, generation)
+
+    def stamp(self, dpath):
+        # Tells the changes seen to dpath apart, which its stat may miss
+        dpath = os.path.normpath(dpath)
+        with self.lock:
+            return self.boot, self.stamps.get(dpath, self.floor)
+
+    def release(self, ticket):
+        if ticket is None:
+            return
+
+        dpath = ticket[0]
+        with self.lock:
+            self.scanning[dpath] -= 1
+            if not self.scanning[dpath]:
+                del self.scanning[dpath]
+                self.forget(dpath)
+
+    def store(self, ticket, value):
+        if ticket is None:
+            return
+
+        dpath, key, version, generation = ticket
+        size = sizeof(value)
+        if size > self.budget:
+            return
+
+        if self.watcher is not None:
+            self.watcher.add(dpath)
+
+        with self.lock:
+            if self.generations[dpath] != generation:
+                # Changed while we were scanning, do not keep a stale value
+                return
+
+            self.discard(dpath, key)
+            self.records[(dpath, key)] = Record(version, value, size, time.monotonic() + self.ttl)
+            self.keys.setdefault(dpath, set()).add(key)
+            self.used += size
+            while self.used > self.budget:
+                (old_dpath, old_key), _ = next(iter(self.records.items()))
+                self.discard(old_dpath, old_key)
+
+    def discard(self, dpath, key):
+        record = self.records.pop((dpath, key), None)
+        if record is None:
+            return
+
+        self.used -= record.size
+        keys = self.keys[dpath]
+        keys.discard(key)
+        if not keys:
+            del self.keys[dpath]
+            if self.watcher is not None:
+                self.watcher.remove(dpath)
+            self.forget(dpath)
+
+    def forget(self, dpath):
+        if dpath not in self.keys and dpath not in self.scanning:
+            self.generations.pop(dpath, None)
+
+    def invalidate(self, dpath):
+        dpath = os.path.normpath(dpath)
+        with self.lock:
+            if dpath in self.generations:
+                self.generations[dpath] += 1
+
+            self.stamps[dpath] = next(self.counter)
+            self.stamps.move_to_end(dpath)
+            while len(self.stamps) > len(self.keys) + STAMP_SLACK:
+                self.stamps.popitem(last=False)
+                self.floor = next(self.counter)
+
+            for key in list(self.keys.get(dpath, ())):
+                self.discard(dpath, key)
+
+    def clear(self):
+        with self.lock:
+            for dpath in self.generations:
+                self.generations[dpath] += 1
+
+            self.stamps.clear()
+            self.floor = next(self.counter)
+
+            for dpath, key in list(self.records):
+                self.discard(dpath, key)
+
+    def on_event(self, dpath, name, mask):
+        if dpath is None:
+            self.clear()
+        else:
+            self.invalidate(dpath)
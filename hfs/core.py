@@ -1,25 +1,41 @@
 #!/usr/bin/env python
 import argparse
+import base64
 import datetime
+import hashlib
+import json
 import mimetypes
+import operator
 import os
+import posixpath
 import re
+import socket
 import sys
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
-from os.path import isdir, join
+from itertools import chain, islice
+from os.path import join
 from shutil import rmtree
+from stat import S_ISDIR
+from urllib.parse import quote, unquote
 
 from hfs import bottle
+from hfs import cache
+from hfs import digest
+from hfs import du
+from hfs import multipart
+from hfs import render
+from hfs import resumable
+from hfs import search
+from hfs import server
 from hfs import show_my_ip
 from hfs.constants import __version__
 
 PROJECT_ROOT = os.path.dirname(os.path.realpath(__file__))
 
-bottle.TEMPLATE_PATH = [
-    join(PROJECT_ROOT, 'html'),
-]
-
 flist_filters = {
     'hidden': lambda x: x.hidden,
     'shown': lambda x: not x.hidden,
@@ -27,20 +43,127 @@ flist_filters = {
     'dir': lambda x: x.isdir,
 }
 
+# What each filter looks at: 0 the name, 1 the type from the directory
+# scan, 2 the stat, 3 the stat against the time of the request
+flist_filter_stages = {
+    'hidden': 0,
+    'shown': 0,
+    'file': 1,
+    'dir': 1,
+}
+
+filter_operators = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+
+size_units = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+age_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+listing_params = ('limit', 'cursor', 'sort', 'order', 'depth', 'search', 'fields')
+
+# Sort keys and the stat-derived value each needs, if any
+listing_sort_values = {
+    'name': None,
+    'ext': None,
+    'size': lambda x: x.size,
+    'mtime': lambda x: x.stat.st_mtime_ns,
+}
+
+# Directories sort by the size of their whole subtree in ?du listings
+deep_size_value = lambda x: x.deep_size
+
+# Rows rendered per chunk of a streamed listing
+listing_batch_size = 500
+
+listing_media_types = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+}
+
+listing_content_types = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columns': 'application/json',
+}
+
+# What ?fields= can pick for json, ndjson and columns listings; only the
+# fields picked are read, names and types come from the directory scan
+listing_fields = {
+    'name': lambda x: x.fname,
+    'type': lambda x: 'dir' if x.isdir else 'file',
+    'dir': lambda x: int(x.isdir),
+    'size': lambda x: x.size,
+    'mtime': lambda x: x.stat.st_mtime,
+    'deletable': lambda x: x.deletable,
+}
+
+# One array per entry in ?columns listings, in this order
+listing_columns = ('name', 'dir', 'size', 'mtime', 'deletable')
+
 deletion_level = 0
 
 upload_pool = set()
+upload_pool_lock = threading.Lock()
+
+acl = ()
+
+listing_cache = None
+
+# Seconds a listing is trusted without a change seen to its directory
+listing_ttl = 30
+
+walk_pool = None
+
+search_index = None
+
+disk_usage = None
+
+# Subdirectories a recursive listing scans ahead of the one being sent
+walk_prefetch = 256
+
+# Bytes read from the socket at once while receiving an upload
+upload_bufsize = 1024 * 1024
 
-acl = []
+# Seconds an unfinished upload is kept after the last data arrived, None
+# keeps it until it is finished or terminated with DELETE
+upload_expiry = 86400
+
+stat_pool = None
+stat_workers = 16
+
+# Seconds a stat has to take on average, over the first stat_sample entries
+# of a listing, for the rest to be stat-ed on stat_pool
+stat_threshold = 0.0002
+stat_sample = 8
 
 
 class FileItem:
-    def __init__(self, fpath):
+    __slots__ = ('fpath', 'fname', 'entry', '_stat', '_isdir', 'usage')
+
+    def __init__(self, fpath, entry=None, fname=None):
         self.fpath = fpath if fpath else '.'
+        self.fname = fname or os.path.basename(self.fpath)
+        self.entry = entry
+        self._stat = None
+        self._isdir = None
+        # (size, files) of the whole subtree of a directory in ?du listings,
+        # either one None while it is measured
+        self.usage = None
 
     @property
-    def fname(self):
-        return os.path.basename(self.fpath)
+    def stat(self):
+        # One stat per item, shared by every property below
+        if self._stat is None:
+            self._stat = self.entry.stat() if self.entry else os.stat(self.fpath)
+
+        return self._stat
 
     @property
     def ftext(self):
@@ -48,7 +171,7 @@ class FileItem:
 
     @property
     def mtime(self):
-        t = datetime.datetime.fromtimestamp(os.path.getmtime(self.fpath))
+        t = datetime.datetime.fromtimestamp(self.stat.st_mtime)
         return '{:04}/{:02}/{:02} {:02}:{:02}:{:02}'.format(
             t.year, t.month, t.day,
             t.hour, t.minute, t.second,
@@ -56,19 +179,73 @@ class FileItem:
 
     @property
     def size(self):
-        return os.path.getsize(self.fpath)
+        return self.stat.st_size
+
+    @property
+    def deep_size(self):
+        if self.usage is not None and self.usage[0] is not None:
+            return self.usage[0]
+
+        return self.size
+
+    @property
+    def size_text(self):
+        if self.usage is not None and self.usage[0] is None:
+            return '?'
+
+        return str(self.deep_size)
+
+    @property
+    def file_count(self):
+        if self.usage is None:
+            return ''
+
+        return '?' if self.usage[1] is None else str(self.usage[1])
+
+    @property
+    def json(self):
+        data = {
+            'name': self.fname,
+            'type': 'dir' if self.isdir else 'file',
+            'size': self.size,
+            'mtime': self.stat.st_mtime,
+            'deletable': self.deletable,
+        }
+        if self.usage is not None:
+            data.update(deep_size=self.usage[0], files=self.usage[1])
+
+        return json.dumps(data)
 
     @property
     def hidden(self):
-        return self.fname.startswith('.')
+        # fname is a relative path in recursive listings
+        return '/.' in '/' + self.fname
 
     @property
     def isdir(self):
-        return isdir(self.fpath)
+        if self._isdir is None:
+            try:
+                if self._stat is None and self.entry is not None:
+                    # d_type from the directory scan, no stat for non-symlinks
+                    self._isdir = self.entry.is_dir()
+                else:
+                    self._isdir = S_ISDIR(self.stat.st_mode)
+            except OSError:
+                self._isdir = False
+
+        return self._isdir
 
     @property
     def exists(self):
-        return os.path.exists(self.fpath)
+        if self.entry is not None and not self.entry.is_symlink():
+            return True
+
+        try:
+            self.stat
+        except OSError:
+            return False
+
+        return True
 
     def __repr__(self):
         return '<FileItem: "{}">'.format(self.ftext)
@@ -83,7 +260,8 @@ class FileItem:
             return False
 
         if deletion_level == 1:
-            return self.fpath in upload_pool
+            with upload_pool_lock:
+                return self.fpath in upload_pool
 
         return True
 
@@ -100,6 +278,84 @@ class DirectoryItem:
         return '<DirectoryItem: "{}">'.format(self.dpath)
 
 
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class ListingOrder:
+    # Directories first, then by the sort key with the name as tie breaker,
+    # so every entry has a distinct key that a page can resume from
+    def __init__(self, sort='name', desc=False, natural=False, deep=False):
+        self.by = sort
+        self.desc = desc
+        self.natural = natural
+        self.value = deep_size_value if deep and sort == 'size' else listing_sort_values[sort]
+
+    def key(self, fitem):
+        return self.make_key(not fitem.isdir, fitem.fname, self.item_value(fitem))
+
+    def make_key(self, isdir_key, fname, value):
+        keys = self.make_keys(fname, value)
+        return (isdir_key, Descending(keys) if self.desc else keys)
+
+    def make_keys(self, fname, value):
+        keys = (natural_key(fname), fname) if self.natural else (fname,)
+        if self.by == 'ext':
+            return (os.path.splitext(fname)[1].lower(),) + keys
+
+        if self.value:
+            return (value,) + keys
+
+        return keys
+
+    def item_value(self, fitem):
+        return self.value(fitem) if self.value else None
+
+    def sort(self, flist):
+        # Same order as key(), sorted in C and split stably into directories
+        # and files
+        if self.by == 'name' and not self.natural:
+            key = operator.attrgetter('fname')
+        else:
+            key = lambda x: self.make_keys(x.fname, self.item_value(x))
+
+        flist = sorted(flist, key=key, reverse=self.desc)
+        dirs = []
+        files = []
+        for x in flist:
+            (dirs if x.isdir else files).append(x)
+
+        return dirs + files
+
+    def cursor(self, fitem):
+        data = [not fitem.isdir, fitem.fname]
+        if self.value:
+            data.append(self.item_value(fitem))
+
+        return encode_cursor(data)
+
+    def cursor_key(self, cursor):
+        data = decode_cursor(cursor, 3 if self.value else 2)
+        return self.make_key(data[0], data[1], data[2] if self.value else None)
+
+
+def natural_key(fname):
+    # "file2" before "file10"; re.split() puts the digit runs at odd indexes
+    return tuple(
+        int(part) if i % 2 else part
+        for i, part in enumerate(re.split(r'(\d+)', fname))
+    )
+
+
 class ACLRule:
     def __init__(self, rule_str):
         # 0.0.0.0
@@ -179,51 +435,78 @@ def static(urlpath):
     return bottle.static_file(urlpath, root=join(PROJECT_ROOT, 'static'))
 
 
-@bottle.route('/<urlpath:path>', method=('GET', 'POST', 'DELETE'))
+@bottle.route('/<urlpath:path>', method=('GET', 'POST', 'PUT', 'PATCH', 'DELETE'))
 def serve(urlpath):
     target = FileItem(urlpath)
     bottle.request.get('REMOTE_ADDR')
     if is_client_denied(bottle.request.get('REMOTE_ADDR')):
         raise bottle.HTTPError(status=403, body='Permission denied')
 
-    if bottle.request.method == 'GET':
-        return (serve_dir if target.isdir else serve_file)(urlpath)
+    # Nothing is read or written outside the served directory
+    if '..' in urlpath.split('/'):
+        raise bottle.HTTPError(status=403, body='Permission denied')
+
+    if bottle.request.method in ('GET', 'HEAD'):
+        # bottle answers HEAD with the GET route
+        if bottle.request.method == 'HEAD' and resumable.get_state(urlpath):
+            return serve_upload_offset(urlpath)
 
-    elif bottle.request.method == 'POST':
         if target.isdir:
-            upload = bottle.request.files.getall('upload')
-            if not upload:
-                # client did not provide a file
-                return bottle.redirect('/{}'.format(urlpath))
+            return serve_dir(urlpath, target.stat)
 
-            for f in upload:
-                fpath = get_uniq_fpath(join(urlpath, f.raw_filename))
-                f.save(fpath)
-                upload_pool.add(fpath)
+        return serve_file(urlpath)
+
+    elif bottle.request.method == 'POST':
+        if target.isdir and ('Upload-Length' in bottle.request.headers or 'Upload-Concat' in bottle.request.headers):
+            return create_upload(urlpath)
+
+        if target.isdir:
+            receive_uploads(urlpath)
 
         return bottle.redirect('/{}'.format(urlpath))
 
+    elif bottle.request.method == 'PUT':
+        return receive_put(urlpath)
+
+    elif bottle.request.method == 'PATCH':
+        return receive_patch(urlpath)
+
     elif bottle.request.method == 'DELETE':
+        if resumable.get_state(urlpath):
+            return terminate_upload(urlpath)
+
         if not deletion_level or not target.deletable:
             raise bottle.HTTPError(status=405, body='Deletion not permitted')
 
         elif not target.exists:
             raise bottle.HTTPError(status=404, body='File "{}" does not exist'.format(target.fpath))
 
-        elif target.isdir:
+        measured = disk_usage.measure_item(target.fpath) if disk_usage is not None else None
+        if target.isdir:
             with suppress(OSError):
                 rmtree(target.fpath)
 
+            forget_removed(target.fpath, measured)
+            invalidate_listing(target.fpath)
+            invalidate_listing(target.parent.fpath)
             return serve_dir(target.parent.fpath)
 
         else:
             os.remove(target.fpath)
+            forget_removed(target.fpath, measured)
+            invalidate_listing(target.parent.fpath)
             return serve_dir(target.parent.fpath)
 
 
+@bottle.error(400)
 @bottle.error(403)
 @bottle.error(404)
 @bottle.error(405)
+@bottle.error(409)
+@bottle.error(411)
+@bottle.error(413)
+@bottle.error(416)
+@bottle.error(503)
 def error_page(error):
     status = error.status
     reason = error.body
@@ -247,11 +530,19 @@ def serve_file(filepath):
     if mimetype is None:
         mimetype='application/octet-stream'
 
-    target_file = bottle.static_file(
-        filepath,
-        root='.',
-        mimetype=mimetype
-    )
+    # Ranges are cut here from the file static_file opened, into a
+    # FileRange the server can sendfile, instead of its 1 MiB read() loop
+    environ = bottle.request.environ
+    range_header = environ.pop('HTTP_RANGE', None)
+    try:
+        target_file = bottle.static_file(
+            filepath,
+            root='.',
+            mimetype=mimetype
+        )
+    finally:
+        if range_header is not None:
+            environ['HTTP_RANGE'] = range_header
 
     if target_file.status_code == 404:
         raise bottle.HTTPError(status=target_file.status, body='File "{}" does not exist'.format(filepath))
@@ -259,47 +550,706 @@ def serve_file(filepath):
     elif target_file.status_code >= 400:
         raise bottle.HTTPError(status=target_file.status)
 
+    elif target_file.status_code == 200 and range_header is not None:
+        size = int(target_file.get_header('Content-Length'))
+        ranges = list(bottle.parse_range_header(range_header, size))
+        if not ranges:
+            if hasattr(target_file.body, 'close'):
+                target_file.body.close()
+
+            raise bottle.HTTPError(
+                status=416, body='Requested Range Not Satisfiable',
+                headers={'Content-Range': 'bytes */{}'.format(size)},
+            )
+
+        offset, end = ranges[0]
+        target_file.status = 206
+        target_file.set_header('Content-Range', 'bytes {}-{}/{}'.format(offset, end - 1, size))
+        target_file.set_header('Content-Length', str(end - offset))
+        if target_file.body:
+            target_file.body = server.FileRange(target_file.body, offset, end - offset)
+
+    # Only a digest stored when the upload was verified, there is none to
+    # send for other files
+    for algorithm in digest.parse_want(bottle.request.get_header('Want-Repr-Digest', '')):
+        with suppress(OSError):
+            value = digest.load(filepath, algorithm)
+            if value is not None:
+                target_file.set_header('Repr-Digest', digest.format_digest(algorithm, value))
+                break
+
     return target_file
 
 
-def serve_dir(filepath):
-    filters = bottle.request.urlparts.query.split('?')
+def serve_dir(filepath, st=None):
+    filters, params = parse_listing_query()
+    fmt = get_listing_format(filters)
+    host = bottle.request.urlparts.netloc
+
+    bottle.response.set_header('Vary', 'Accept, User-Agent')
+    if fmt in listing_content_types:
+        bottle.response.content_type = listing_content_types[fmt]
+
+    if fmt == 'html' and 'virtual' in filters:
+        # A small page, the entries are fetched as ?columns in pages
+        return render.virtual_page(host, get_ancestors_dlist(filepath), filepath)
+
+    order = get_listing_order(filters, params)
+    predicate = compile_filters(filters)
+    fields = get_listing_fields(fmt, params)
+    found = 'search' in params
+    recursive = 'recursive' in filters and not found
+    usage = 'du' in filters
+    if usage and recursive:
+        raise bottle.HTTPError(status=400, body='Directory sizes are not shown in recursive listings')
+
+    if usage and disk_usage is None:
+        raise bottle.HTTPError(status=400, body='Directory sizes are disabled, see --du')
+
+    # Listings of a single directory are validated by one stat of it and
+    # answered with a 304 before it is scanned; what mtime filters let
+    # through changes without the directory changing
+    timeless = tuple(token for token in filters if not is_age_filter(token))
+    age_predicate = compile_filters(filters, (3,)) if len(timeless) != len(filters) else None
+    validated = not (recursive or found or usage or age_predicate)
+    cacheable = listing_cache is not None and validated
+    key = (fmt, filepath, host, tuple(filters), tuple(sorted(params.items())))
+    if validated:
+        etag = get_listing_etag(filepath, st, key)
+        if etag is not None:
+            bottle.response.set_header('ETag', etag)
+            if etag_matches(etag):
+                bottle.response.status = 304
+                return ''
+
+    # Entries are filtered by name and type first, only those that pass are
+    # stat-ed for the other filters, and for display only those sent
+    stat_predicate = compile_filters(filters, (2,)) if filters_need_stat(filters) else None
+    scan_predicate = compile_filters(filters, (0, 1))
+    stat_listed = listing_needs_stat(fmt, filters, fields, order)
+
+    def scan():
+        flist = cached(filepath, ('flist',) + timeless, lambda: get_flist(filepath, scan_predicate, stat_predicate))
+        return attach_usage(flist) if usage else flist
+
+    def sort(flist):
+        if order.value is not None:
+            prefetch_stats(flist)
+
+        return order.sort(flist)
+
+    def sorted_scan():
+        # Sorted once per order next to the scan, pages are cut from it by
+        # bisection; sizes with ?du change without the directory changing
+        if usage:
+            flist = sort(scan())
+        else:
+            flist = cached(filepath, ('sorted', order.by, order.desc, order.natural) + timeless, lambda: sort(scan()))
+
+        if age_predicate is not None:
+            prefetch_stats(flist)
+            flist = list(filter(age_predicate, flist))
+
+        return flist
+
+    def listing():
+        flist = sorted_scan()
+        if stat_listed:
+            prefetch_stats(flist)
+
+        return flist
+
+    # A directory that can not be scanned is an error page, not a 200 cut
+    # short after the first chunk
+    try:
+        if found:
+            # Searched before the first chunk, a missing index is a 503
+            found_flist = search_flist(filepath, params['search'], predicate)
+            if usage:
+                found_flist = attach_usage(found_flist)
+
+            sorted_scan = lambda: sort(found_flist)
+
+        next_url = None
+        if recursive:
+            if 'limit' in params or params.get('cursor'):
+                raise bottle.HTTPError(status=400, body='Recursive listings cannot be paginated')
+
+            depth = get_count(params, 'depth') if 'depth' in params else None
+            listing = lambda: primed(iter_tree(filepath, order, predicate, depth))
+
+        elif 'limit' in params or params.get('cursor'):
+            # The Link header has to be set before the first chunk is sent,
+            # so a page is cut out of the scan up front
+            page, next_cursor = get_page(sorted_scan(), order, params)
+            if stat_listed:
+                prefetch_stats(page)
+
+            listing = lambda: page
+            if next_cursor:
+                next_url = get_page_url(next_cursor)
+                bottle.response.set_header('Link', '<{}>; rel="next"'.format(next_url))
+
+        # The listing is sent with chunked encoding as it is rendered;
+        # everything taken from the request is bound here, the chunks are
+        # generated later
+        args = {
+            'ancestors_dlist': get_ancestors_dlist(filepath),
+            'curdir': filepath,
+            'host': host,
+            'pipe': 'pipe' in filters,
+            'next_url': next_url,
+            'du': usage,
+            'fields': fields,
+        }
+        renderer = listing_renderers[fmt]
+        if recursive and fmt == 'curl':
+            renderer = iter_curl_tree
+
+        chunks = renderer(listing, args)
+        if cacheable:
+            chunks = listing_cache.get_chunks(filepath, ('render',) + key, chunks)
+            if isinstance(chunks, str):
+                return chunks
+
+        # Run up to the first chunk, which comes after the scan
+        return primed(chunks)
+
+    except PermissionError:
+        raise bottle.HTTPError(status=403, body='Permission denied')
 
-    args = {
-        'ancestors_dlist': get_ancestors_dlist(filepath),
-        'curdir': filepath,
-        'flist': get_flist(filepath, filters),
-        'host': bottle.request.urlparts.netloc,
-        'pipe': 'pipe' in filters,
-    }
+    except (FileNotFoundError, NotADirectoryError):
+        raise bottle.HTTPError(status=404, body='Directory "{}" does not exist'.format(filepath))
 
-    if is_user_agent_curl():
-        return bottle.template('curl-listdir.html', **args)
 
-    return bottle.template('listdir.html', **args)
+def iter_html_listing(scan, args):
+    flist = scan()
+    yield render.html_head(args['host'], args['ancestors_dlist'])
 
+    def rows(flist):
+        return render.html_rows(flist, args['curdir'], args['du'])
 
-def get_flist(filepath, filters):
-    raw_flist = filter(
-        lambda x: x.exists,
-        map(
-            lambda x: FileItem(join(filepath, x)),
-            os.listdir(filepath)
-        )
+    hidden_flist, shown_flist = split_hidden(flist)
+    if hidden_flist:
+        yield render.HTML_HIDDEN_HEAD
+        yield from iter_rows(rows, hidden_flist)
+        yield render.HTML_HIDDEN_TAIL
+
+    yield render.HTML_SHOWN_HEAD
+    yield from iter_rows(rows, shown_flist)
+    yield render.html_tail(args['curdir'], args['next_url'])
+
+
+def iter_curl_listing(scan, args):
+    if args['pipe']:
+        yield from iter_rows(render.pipe_rows, scan())
+        return
+
+    flist = scan()
+    yield render.curl_head(args['host'], args['ancestors_dlist'])
+
+    size_width = max(*map(lambda x: len(x.size_text), flist), 4, 0)
+    files_width = max(*map(lambda x: len(x.file_count), flist), 5, 0)
+
+    def rows(flist):
+        return render.curl_rows(flist, size_width, files_width, args['du'])
+
+    hidden_flist, shown_flist = split_hidden(flist)
+    yield from iter_rows(rows, hidden_flist)
+    if hidden_flist and shown_flist:
+        yield render.RULE
+
+    yield from iter_rows(rows, shown_flist)
+    yield render.curl_tail(args['host'], args['next_url'])
+
+
+def iter_curl_tree(scan, args):
+    if args['pipe']:
+        yield from iter_rows(render.pipe_rows, scan())
+        return
+
+    flist = scan()
+    yield render.curl_head(args['host'], args['ancestors_dlist'])
+
+    # Rows go out before the walk is complete, the size column fits 1 TB
+    def rows(flist):
+        return render.curl_rows(flist, 13, 0, False)
+
+    yield from iter_rows(rows, flist)
+    yield render.curl_tail(args['host'], args['next_url'])
+
+
+def split_hidden(flist):
+    hidden_flist = []
+    shown_flist = []
+    for x in flist:
+        (hidden_flist if x.hidden else shown_flist).append(x)
+
+    return hidden_flist, shown_flist
+
+
+def iter_json_listing(scan, args):
+    flist = scan()
+    yield '{{"path": {}, "next": {}, "entries": ['.format(
+        json.dumps(args['ancestors_dlist'][-1].dpath),
+        json.dumps(args['next_url']),
     )
 
-    for f in filters:
-        raw_flist = filter(
-            flist_filters.get(f, lambda x: x),
-            raw_flist,
-        )
+    fields = args['fields']
+    sep = '\n'
+    for batch in iter_batches(flist):
+        yield sep + ',\n'.join(x.json if fields is None else project(x, fields) for x in batch)
+        sep = ',\n'
+
+    yield '\n]}\n'
+
 
-    return sorted(
-        raw_flist,
-        key=lambda x: x.isdir,
-        reverse=True
+def iter_columns_listing(scan, args):
+    flist = scan()
+    fields = args['fields']
+    yield '{{"path": {}, "next": {}, "fields": {}, "rows": ['.format(
+        json.dumps(args['ancestors_dlist'][-1].dpath),
+        json.dumps(args['next_url']),
+        json.dumps(fields),
     )
 
+    getters = [listing_fields[field] for field in fields]
+    sep = '\n'
+    for batch in iter_batches(flist):
+        yield sep + ',\n'.join(json.dumps([get(x) for get in getters]) for x in batch)
+        sep = ',\n'
+
+    yield '\n]}\n'
+
+
+def iter_ndjson_listing(scan, args):
+    fields = args['fields']
+    for batch in iter_batches(scan()):
+        yield ''.join((x.json if fields is None else project(x, fields)) + '\n' for x in batch)
+
+
+def project(fitem, fields):
+    return json.dumps({field: listing_fields[field](fitem) for field in fields})
+
+
+listing_renderers = {
+    'html': iter_html_listing,
+    'curl': iter_curl_listing,
+    'json': iter_json_listing,
+    'ndjson': iter_ndjson_listing,
+    'columns': iter_columns_listing,
+}
+
+
+def primed(chunks):
+    # Errors before the first item are raised here, not once it is iterated
+    chunks = iter(chunks)
+    for first in chunks:
+        return chain((first,), chunks)
+
+    return iter(())
+
+
+def iter_rows(rows, flist):
+    for batch in iter_batches(flist):
+        yield rows(batch)
+
+
+def iter_batches(flist):
+    flist = iter(flist)
+    batch = list(islice(flist, listing_batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(flist, listing_batch_size))
+
+
+def iter_tree(filepath, order, predicate, depth):
+    # Depth first like find(1), entries prefixed with their path below
+    # filepath. Every scan on walk_pool queues the scans of its own
+    # subdirectories, so on network filesystems the scandir round trips of
+    # the whole tree overlap while entries are sent in order
+    exists = compile_filters(())
+    lock = threading.Lock()
+    pending = {}
+    closed = False
+
+    def scan(dpath, level):
+        flist = order.sort(cached(dpath, ('flist',), lambda: get_flist(dpath, exists)))
+        prefetch(flist, level)
+        return flist
+
+    def prefetch(flist, level):
+        if walk_pool is None:
+            return
+
+        with lock:
+            for x in flist:
+                if closed or len(pending) >= walk_prefetch:
+                    break
+
+                if descend(x, level):
+                    pending[x.fpath] = walk_pool.submit(scan, x.fpath, level + 1)
+
+    def descend(fitem, level):
+        return fitem.isdir and not fitem.entry.is_symlink() and (depth is None or level < depth)
+
+    def open_dir(dpath, prefix, level):
+        with lock:
+            future = pending.pop(dpath, None)
+
+        flist = future.result() if future else scan(dpath, level)
+        return iter(flist), prefix, level
+
+    try:
+        stack = [open_dir(filepath, '', 1)]
+        while stack:
+            flist, prefix, level = stack[-1]
+            x = next(flist, None)
+            if x is None:
+                stack.pop()
+                continue
+
+            fitem = FileItem(x.fpath, x.entry, prefix + x.fname)
+            if predicate(fitem):
+                yield fitem
+
+            if descend(x, level):
+                with suppress(OSError):
+                    stack.append(open_dir(x.fpath, fitem.fname + '/', level + 1))
+    finally:
+        with lock:
+            closed = True
+            for future in pending.values():
+                future.cancel()
+
+
+def get_listing_format(filters):
+    for fmt in listing_content_types:
+        if fmt in filters:
+            return fmt
+
+    # First known media range wins, q-values are not weighed
+    for media_range in bottle.request.get_header('Accept', default='').split(','):
+        fmt = listing_media_types.get(media_range.partition(';')[0].strip().lower())
+        if fmt:
+            return fmt
+
+    return 'curl' if is_user_agent_curl() else 'html'
+
+
+def parse_listing_query():
+    filters = []
+    params = {}
+    for token in re.split(r'[?&]', bottle.request.urlparts.query):
+        key, sep, value = token.partition('=')
+        if sep and key in listing_params:
+            params[key] = unquote(value)
+        else:
+            filters.append(unquote(token))
+
+    return filters, params
+
+
+def get_listing_fields(fmt, params):
+    if 'fields' not in params:
+        return listing_columns if fmt == 'columns' else None
+
+    if fmt not in ('json', 'ndjson', 'columns'):
+        raise bottle.HTTPError(status=400, body='Fields can only be picked for json, ndjson and columns listings')
+
+    fields = tuple(params['fields'].split(','))
+    for field in fields:
+        if field not in listing_fields:
+            raise bottle.HTTPError(status=400, body='Invalid field "{}"'.format(field))
+
+    return fields
+
+
+def get_listing_order(filters, params):
+    sort = params.get('sort', 'name')
+    if sort not in listing_sort_values:
+        raise bottle.HTTPError(status=400, body='Invalid sort "{}"'.format(sort))
+
+    order = params.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise bottle.HTTPError(status=400, body='Invalid order "{}"'.format(order))
+
+    return ListingOrder(sort, order == 'desc', 'natural' in filters, 'du' in filters)
+
+
+def get_page(flist, order, params):
+    # Keyset pagination: the cursor is the sort key of the last entry sent,
+    # so pages stay consistent while the directory changes in between.
+    # flist is sorted by order, a page costs a bisection and a slice
+    limit = get_count(params, 'limit') if 'limit' in params else len(flist)
+
+    start = 0
+    if params.get('cursor'):
+        start = bisect_flist(flist, order.cursor_key(params['cursor']), order.key)
+
+    page = flist[start:start + limit]
+    if start + limit >= len(flist):
+        return page, None
+
+    return page, order.cursor(page[-1])
+
+
+def bisect_flist(flist, key, sort_key):
+    lo, hi = 0, len(flist)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < sort_key(flist[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return lo
+
+
+def encode_cursor(key):
+    data = json.dumps(key, separators=(',', ':')).encode('utf-8', 'surrogatepass')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(data.decode('utf-8', 'surrogatepass'))
+        if not isinstance(data, list) or len(data) != length:
+            raise ValueError
+
+        if not isinstance(data[0], bool) or not isinstance(data[1], str):
+            raise ValueError
+
+        if length > 2 and (not isinstance(data[2], int) or isinstance(data[2], bool)):
+            raise ValueError
+    except ValueError:
+        raise bottle.HTTPError(status=400, body='Invalid cursor "{}"'.format(cursor))
+
+    return data
+
+
+def get_count(params, key):
+    try:
+        count = int(params[key])
+        if count < 1:
+            raise ValueError
+    except ValueError:
+        raise bottle.HTTPError(status=400, body='Invalid {} "{}"'.format(key, params[key]))
+
+    return count
+
+
+def get_page_url(cursor):
+    query = [
+        token for token in re.split(r'[?&]', bottle.request.urlparts.query)
+        if token and not token.startswith('cursor=')
+    ]
+    return '{}?{}'.format(bottle.request.urlparts.path, '&'.join(query + ['cursor=' + cursor]))
+
+
+def cached(filepath, key, build):
+    if listing_cache is None:
+        return build()
+
+    return listing_cache.get(filepath, key, build)
+
+
+def get_listing_etag(filepath, st, key):
+    # The directory version, the changes to it the cache saw, and the ttl
+    # period, which bounds how long changes that touch neither go unseen.
+    # None if there is no telling
+    if listing_ttl <= 0:
+        return None
+
+    try:
+        st = st or os.stat(filepath)
+    except OSError:
+        return None
+
+    stamp = listing_cache.stamp(filepath) if listing_cache is not None else None
+    validator = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, stamp, int(time.time() // listing_ttl))
+
+    # Who may delete what is part of the page
+    data = repr((validator, key, deletion_level)).encode('utf-8', 'surrogateescape')
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+
+def etag_matches(etag):
+    header = bottle.request.get_header('If-None-Match')
+    if not header:
+        return False
+
+    tags = [x.strip() for x in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def invalidate_listing(filepath):
+    if listing_cache is not None:
+        listing_cache.invalidate(filepath)
+
+
+def get_flist(filepath, predicate, stat_predicate=None):
+    # stat_predicate tests what predicate let through, stat-ed up front
+    with os.scandir(filepath) as entries:
+        flist = list(filter(predicate, (
+            FileItem(entry.path, entry, entry.name) for entry in entries if not resumable.is_upload(entry.name)
+        )))
+
+    if stat_predicate is not None:
+        prefetch_stats(flist)
+        flist = list(filter(stat_predicate, flist))
+
+    return flist
+
+
+def is_age_filter(token):
+    return re.match(r'^mtime[<>=!]', token) is not None
+
+
+def filters_need_stat(filters):
+    tests = (compile_filter(token) for token in filters)
+    return any(test is not None and test[0] == 2 for test in tests)
+
+
+def listing_needs_stat(fmt, filters, fields, order):
+    if order.value is not None:
+        return True
+
+    if fmt in ('json', 'ndjson', 'columns'):
+        return fields is None or 'size' in fields or 'mtime' in fields
+
+    return 'pipe' not in filters
+
+
+def prefetch_stats(flist):
+    # On NFS or SMB every stat is a network round trip. When the first few
+    # show it, the others are stat-ed concurrently, a few chunks per worker
+    if stat_pool is None:
+        return
+
+    pending = [x for x in flist if x._stat is None]
+    sample, rest = pending[:stat_sample], pending[stat_sample:]
+    start = time.monotonic()
+    stat_items(sample)
+    if not rest or time.monotonic() - start < stat_threshold * len(sample):
+        return
+
+    size = -(-len(rest) // (stat_workers * 4))
+    for _ in stat_pool.map(stat_items, [rest[i:i + size] for i in range(0, len(rest), size)]):
+        pass
+
+
+def stat_items(flist):
+    # Errors are raised again where the stat is read
+    for x in flist:
+        with suppress(OSError):
+            x.stat
+
+
+def search_flist(filepath, pattern, predicate):
+    if search_index is None:
+        raise bottle.HTTPError(status=400, body='Search is disabled, see --search-index')
+
+    if not pattern:
+        raise bottle.HTTPError(status=400, body='Empty search')
+
+    paths = search_index.search(filepath, pattern)
+    if paths is None:
+        raise bottle.HTTPError(status=503, body='The search index is being built, try again later')
+
+    # Named by their path below filepath, like the entries of ?recursive
+    prefix = os.path.normpath(filepath) + '/'
+    return list(filter(
+        predicate,
+        (FileItem(p, fname=p[len(prefix):] if p.startswith(prefix) else p) for p in paths),
+    ))
+
+
+def forget_removed(fpath, measured):
+    if os.path.lexists(fpath):
+        return
+
+    if search_index is not None:
+        search_index.remove(fpath)
+
+    if disk_usage is not None:
+        disk_usage.removed(fpath, measured)
+
+
+def attach_usage(flist):
+    # On copies of the directories with a fresh stat, the scanned ones are
+    # shared through the listing cache and may predate changes inside them
+    result = []
+    for x in flist:
+        if x.isdir:
+            y = FileItem(x.fpath, fname=x.fname)
+            with suppress(OSError):
+                y.usage = disk_usage.get(y.fpath, y.stat)
+                x = y
+
+        result.append(x)
+
+    return result
+
+
+def compile_filters(filters, stages=(0, 1, 2, 3)):
+    # The filter tokens of the given stages as one predicate, tests on the
+    # name first so entries they reject are never stat-ed; tokens that are
+    # not filters are ignored
+    tests = [(1, lambda x: x.exists)]
+    for token in filters:
+        test = compile_filter(token)
+        if test is not None:
+            tests.append(test)
+
+    tests = [test for stage, test in sorted(tests, key=lambda x: x[0]) if stage in stages]
+    if len(tests) == 1:
+        return tests[0]
+
+    return lambda x: all(test(x) for test in tests)
+
+
+def compile_filter(token):
+    # hidden, shown, file, dir, size>100M, mtime<7d, ext=iso,img, name~regex
+    if token in flist_filters:
+        return flist_filter_stages[token], flist_filters[token]
+
+    m = re.match(r'^(size|mtime|ext|name)(<=|>=|!=|!~|<|>|=|~)(.+)$', token)
+    if not m:
+        return None
+
+    key, op, value = m.groups()
+    compare = filter_operators.get(op)
+    if key == 'size' and compare:
+        m = re.match(r'^(\d+(?:\.\d+)?)([kmgt]?)(?:i?b)?$', value, re.IGNORECASE)
+        if m:
+            size = float(m.group(1)) * size_units[m.group(2).lower()]
+            return 2, lambda x: compare(x.size, size)
+
+    elif key == 'mtime' and compare:
+        # Compares the age: mtime<7d is modified in the last 7 days
+        m = re.match(r'^(\d+(?:\.\d+)?)([smhdw])$', value)
+        if m:
+            age = float(m.group(1)) * age_units[m.group(2)]
+            now = time.time()
+            return 3, lambda x: compare(now - x.stat.st_mtime, age)
+
+    # fname is a relative path in recursive and search listings
+    elif key == 'ext' and op in ('=', '!='):
+        exts = tuple('.' + ext.lower() for ext in value.split(','))
+        return 0, lambda x: posixpath.basename(x.fname).lower().endswith(exts) == (op == '=')
+
+    elif key == 'name' and op in ('~', '!~'):
+        with suppress(re.error):
+            regex = re.compile(value)
+            return 0, lambda x: bool(regex.search(posixpath.basename(x.fname))) == (op == '~')
+
+    elif key == 'name' and op in ('=', '!='):
+        return 0, lambda x: (posixpath.basename(x.fname) == value) == (op == '=')
+
+    raise bottle.HTTPError(status=400, body='Invalid filter "{}"'.format(token))
+
 
 def get_ancestors_dlist(filepath):
     if filepath == '.':
@@ -315,6 +1265,387 @@ def get_ancestors_dlist(filepath):
     return ancestors_dlist
 
 
+def receive_uploads(dpath):
+    # Every "upload" file of a multipart/form-data POST is written straight
+    # to its own new file in dpath as it comes off the socket. A "digest"
+    # field is checked against the upload after it, Content-Digest against
+    # the whole body
+    boundary = multipart.get_boundary(bottle.request.environ.get('CONTENT_TYPE', ''))
+    if boundary is None:
+        raise bottle.HTTPError(status=400, body='Uploads have to be multipart/form-data')
+
+    body_hasher = get_upload_hasher('Content-Digest')
+    chunks = iter_request_body()
+    if body_hasher is not None:
+        chunks = body_hasher.wrap(chunks)
+
+    saved = []
+    try:
+        try:
+            hasher = None
+            for part in multipart.MultipartParser(chunks, boundary):
+                if part.name == 'digest' and not part.filename:
+                    hasher = make_hasher(read_field(part))
+                    continue
+
+                if part.name != 'upload' or not part.filename:
+                    continue
+
+                before = get_dir_version(dpath)
+                fpath = reserve_uniq_fpath(join(dpath, get_upload_name(part.filename)))
+                try:
+                    with open(fpath, 'wb') as f:
+                        for data in (part if hasher is None else hasher.wrap(part)):
+                            f.write(data)
+
+                    verified = hasher and (hasher.algorithm, check_digest(hasher))
+                except BaseException:
+                    os.remove(fpath)
+                    raise
+
+                saved.append((fpath, verified, before))
+                hasher = None
+
+        except multipart.MultipartError as e:
+            raise bottle.HTTPError(status=400, body='Malformed upload: {}'.format(e))
+
+        if body_hasher is not None:
+            check_digest(body_hasher)
+
+    except BaseException:
+        if body_hasher is not None:
+            # Nothing is kept of a body that does not match its digest
+            for fpath, *_ in saved:
+                os.remove(fpath)
+
+            saved = []
+
+        raise
+
+    finally:
+        for fpath, verified, before in saved:
+            register_upload(fpath, verified, before)
+
+
+def read_field(part):
+    value = b''
+    for data in part:
+        value += data
+        if len(value) > 1024:
+            raise bottle.HTTPError(status=400, body='Form field "{}" too long'.format(part.name))
+
+    return value.decode('latin-1')
+
+
+def get_upload_hasher(*headers):
+    # For the first of the digest headers the request has, None without
+    for header in headers:
+        text = bottle.request.get_header(header)
+        if text:
+            return make_hasher(text)
+
+    return None
+
+
+def make_hasher(text):
+    try:
+        return digest.Hasher(digest.parse(text))
+    except digest.DigestError as e:
+        raise bottle.HTTPError(status=400, body='Invalid digest: {}'.format(e))
+
+
+def check_digest(hasher):
+    try:
+        return hasher.verify()
+    except digest.DigestError as e:
+        raise bottle.HTTPError(status=400, body='Upload corrupted: {}'.format(e))
+
+
+def receive_put(urlpath):
+    # curl -T: the body is the file, saved as urlpath or the first free name
+    # after it, like a POST upload
+    request = bottle.request
+    if urlpath.endswith('/') or FileItem(urlpath).isdir:
+        raise bottle.HTTPError(status=400, body='PUT needs a file name, like /dir/name')
+
+    dpath = os.path.dirname(urlpath) or '.'
+    if not os.path.isdir(dpath):
+        raise bottle.HTTPError(status=404, body='Directory "{}" does not exist'.format(dpath))
+
+    if not request.chunked and request.content_length < 0:
+        raise bottle.HTTPError(status=411, body='Content-Length required')
+
+    hasher = get_upload_hasher('Content-Digest', 'Repr-Digest')
+    chunks = iter_request_body()
+    if hasher is not None:
+        chunks = hasher.wrap(chunks)
+
+    before = get_dir_version(dpath)
+    fpath = reserve_uniq_fpath(urlpath)
+    try:
+        size = 0
+        with open(fpath, 'wb') as f:
+            for data in chunks:
+                f.write(data)
+                size += len(data)
+
+        if not request.chunked and size < request.content_length:
+            raise bottle.HTTPError(status=400, body='Upload cut short')
+
+        verified = hasher and (hasher.algorithm, check_digest(hasher))
+    except BaseException:
+        os.remove(fpath)
+        raise
+
+    register_upload(fpath, verified, before)
+    if verified:
+        bottle.response.set_header('Repr-Digest', digest.format_digest(*verified))
+
+    bottle.response.status = 201
+    bottle.response.set_header('Location', '/' + quote(fpath))
+    return 'Saved as /{}\n'.format(fpath)
+
+
+def create_upload(dpath):
+    # A resumable upload: POST with Upload-Length and the percent-encoded
+    # Upload-Name, then PATCH its Location with Upload-Offset from where the
+    # data is to continue; HEAD tells the offset after a broken connection.
+    # "Upload-Concat: final" creates an upload sent in parts instead, each
+    # created with "Upload-Concat: partial;<Location>", its Upload-Start and
+    # Upload-Length, and "Upload-Concat: final;<part> <part> ..." finishes
+    # it. A Repr-Digest is checked once the upload is complete
+    request = bottle.request
+    concat = request.get_header('Upload-Concat', '')
+    if concat.startswith('final;'):
+        return finish_parts(dpath, [unquote(url).lstrip('/') for url in concat[len('final;'):].split()])
+
+    if upload_expiry is not None:
+        resumable.expire(dpath, upload_expiry)
+
+    length = get_upload_number('Upload-Length')
+    if concat.startswith('partial;'):
+        return create_part(dpath, unquote(concat[len('partial;'):].strip()).lstrip('/'), length)
+
+    if concat not in ('', 'final'):
+        raise bottle.HTTPError(status=400, body='Invalid Upload-Concat')
+
+    name = get_upload_name(unquote(request.get_header('Upload-Name', '')))
+    expected = request.get_header('Repr-Digest')
+    if expected:
+        make_hasher(expected)
+
+    parts = concat == 'final'
+    upath = resumable.create(dpath, name, length, expected, parts)
+    invalidate_listing(dpath)
+    if not length and not parts:
+        upath = finish_upload(upath, name, verify_upload([upath], expected, None))
+
+    bottle.response.status = 201
+    bottle.response.set_header('Location', '/' + quote(upath))
+    bottle.response.set_header('Upload-Offset', '0')
+    return ''
+
+
+def get_upload_number(header):
+    try:
+        value = int(bottle.request.get_header(header, ''))
+    except ValueError:
+        value = -1
+
+    if value < 0:
+        raise bottle.HTTPError(status=400, body='Invalid {}'.format(header))
+
+    return value
+
+
+def create_part(dpath, target, length):
+    start = get_upload_number('Upload-Start')
+    state = resumable.get_state(target)
+    if state is None or not state['parts'] or os.path.normpath(join(dpath, os.path.basename(target))) != target:
+        raise bottle.HTTPError(status=404, body='No upload sent in parts at "{}"'.format(target))
+
+    if start + length > state['length']:
+        raise bottle.HTTPError(status=400, body='The part ends after the upload')
+
+    upath = resumable.create_part(target, start, length)
+    invalidate_listing(dpath)
+    bottle.response.status = 201
+    bottle.response.set_header('Location', '/' + quote(upath))
+    bottle.response.set_header('Upload-Offset', '0')
+    return ''
+
+
+def finish_parts(dpath, upaths):
+    if not upaths or len(set(upaths)) != len(upaths):
+        raise bottle.HTTPError(status=400, body='No parts, or a part twice')
+
+    for upath in upaths:
+        if os.path.normpath(join(dpath, os.path.basename(upath))) != upath:
+            raise bottle.HTTPError(status=400, body='"{}" is no part of an upload here'.format(upath))
+
+    expected = bottle.request.get_header('Repr-Digest')
+    if expected:
+        make_hasher(expected)
+
+    def complete(target, state):
+        # Written in place by the parts, so the result is read back
+        expected_digest = expected or state['digest']
+        verified = verify_upload([target] + upaths, expected_digest, None)
+        done.append(finish_upload(target, state['name'], verified))
+
+    done = []
+    try:
+        resumable.finish_parts(upaths, complete)
+    except resumable.UploadGone as e:
+        raise bottle.HTTPError(status=404, body='No upload in progress at "{}"'.format(e.upath))
+    except resumable.UploadConflict:
+        raise bottle.HTTPError(status=409, body='A part is not complete')
+    except resumable.InvalidParts as e:
+        raise bottle.HTTPError(status=400, body=str(e))
+
+    invalidate_listing(dpath)
+    bottle.response.status = 201
+    bottle.response.set_header('Location', '/' + quote(done[0]))
+    return ''
+
+
+def terminate_upload(upath):
+    try:
+        resumable.terminate(upath)
+    except resumable.UploadGone:
+        raise bottle.HTTPError(status=404, body='No upload in progress at "{}"'.format(upath))
+    except resumable.UploadConflict:
+        raise bottle.HTTPError(status=409, body='The upload is busy')
+
+    invalidate_listing(os.path.dirname(upath) or '.')
+    bottle.response.status = 204
+    return ''
+
+
+def serve_upload_offset(upath):
+    state = resumable.get_state(upath)
+    bottle.response.set_header('Upload-Offset', str(state['offset']))
+    bottle.response.set_header('Upload-Length', str(state['length']))
+    bottle.response.set_header('Cache-Control', 'no-store')
+    return ''
+
+
+def receive_patch(upath):
+    state = resumable.get_state(upath)
+    if state is None:
+        raise bottle.HTTPError(status=404, body='No upload in progress at "{}"'.format(upath))
+
+    try:
+        offset = int(bottle.request.get_header('Upload-Offset'))
+    except (TypeError, ValueError):
+        raise bottle.HTTPError(status=400, body='Invalid Upload-Offset')
+
+    if state['parts']:
+        raise bottle.HTTPError(status=403, body='The upload is sent in parts')
+
+    chunks = iter_request_body()
+    hasher = None
+    if state['digest'] and offset == 0:
+        # Sent in one go, hashed on the way to the disk
+        hasher = make_hasher(state['digest'])
+        chunks = hasher.wrap(chunks)
+
+    def complete():
+        verified = verify_upload([upath], state['digest'], hasher)
+        done.append(finish_upload(upath, state['name'], verified))
+
+    done = []
+    try:
+        if state['partial']:
+            offset = resumable.write_part(upath, offset, chunks)
+        else:
+            offset = resumable.append(upath, offset, state['length'], chunks, complete)
+
+    except resumable.UploadGone:
+        raise bottle.HTTPError(status=404, body='No upload in progress at "{}"'.format(upath))
+    except resumable.UploadConflict as e:
+        raise bottle.HTTPError(
+            status=409,
+            body='Upload-Offset does not match, or the upload is busy',
+            headers={'Upload-Offset': str(e.offset)} if e.offset is not None else None,
+        )
+    except resumable.UploadTooLong:
+        raise bottle.HTTPError(status=413, body='More data than Upload-Length')
+
+    bottle.response.status = 204
+    bottle.response.set_header('Upload-Offset', str(offset))
+    if done:
+        bottle.response.set_header('Location', '/' + quote(done[0]))
+
+    return ''
+
+
+def verify_upload(upaths, expected, hasher):
+    # (algorithm, digest) of the complete upaths[0], None if no digest was
+    # given. A resumed upload is read back from the disk. Uploads that do
+    # not match are dropped, together with the other parts in upaths
+    if not expected:
+        return None
+
+    if hasher is None:
+        hasher = make_hasher(expected)
+        digest.hash_file(upaths[0], hasher)
+
+    try:
+        return hasher.algorithm, check_digest(hasher)
+    except bottle.HTTPError:
+        for upath in upaths:
+            resumable.discard(upath)
+
+        raise
+
+
+def finish_upload(upath, name, verified=None):
+    fpath = reserve_uniq_fpath(join(os.path.dirname(upath), name))
+    resumable.finish(upath, fpath)
+    register_upload(fpath, verified)
+    if verified:
+        bottle.response.set_header('Repr-Digest', digest.format_digest(*verified))
+
+    return fpath
+
+
+def iter_request_body():
+    request = bottle.request
+    read = request.environ['wsgi.input'].read
+    if request.chunked:
+        return request._iter_chunked(read, upload_bufsize)
+
+    return request._iter_body(read, upload_bufsize)
+
+
+def get_upload_name(filename):
+    # Some browsers send the whole client side path
+    fname = filename.replace('\\', '/').rpartition('/')[2]
+    if fname in ('', '.', '..'):
+        raise bottle.HTTPError(status=400, body='Invalid file name "{}"'.format(filename))
+
+    return fname
+
+
+def register_upload(fpath, verified=None, before=None):
+    # before: the version of its directory for disk_usage, taken before
+    # fpath was created
+    with upload_pool_lock:
+        upload_pool.add(fpath)
+
+    if verified:
+        digest.store(fpath, *verified)
+
+    if search_index is not None:
+        search_index.add(fpath)
+
+    if disk_usage is not None:
+        disk_usage.added(fpath, before)
+
+    invalidate_listing(os.path.dirname(fpath) or '.')
+
+
 def get_uniq_fpath(filepath):
     fitem = FileItem(filepath)
     if not fitem.exists:
@@ -330,9 +1661,26 @@ def get_uniq_fpath(filepath):
     return fitem.fpath
 
 
+def get_dir_version(dpath):
+    return disk_usage.version(dpath) if disk_usage is not None else None
+
+
+def reserve_uniq_fpath(filepath):
+    # Another worker may pick the same name between probing and creating it
+    while True:
+        fpath = get_uniq_fpath(filepath)
+        with suppress(FileExistsError):
+            open(fpath, 'xb').close()
+            return fpath
+
+
 def main():
     global deletion_level
     global acl
+    global stat_workers
+    global stat_threshold
+    global upload_expiry
+    global listing_ttl
     parser = argparse.ArgumentParser(
         description='Tiny HTTP File Server',
         prog='hfs')
@@ -343,6 +1691,51 @@ def main():
         '-a', '--acl',
         help='Access Control List (first match), in the following format: "127.0.0.1", "127.0.0.1/24", "127.0.0.1/255.255.255.0". Prefix a "d" to deny a subnet',
         nargs='*', default=[])
+    parser.add_argument('-s', '--server',
+        help='Serving engine: a pool of worker threads, or a single asyncio event loop',
+        choices=sorted(server.engines), default='thread')
+    parser.add_argument('-w', '--workers',
+        help='Number of worker threads serving requests concurrently, with asyncio the threads running the app',
+        type=int, default=16)
+    parser.add_argument('--queue-size',
+        help='Number of connections with a request waiting for a free worker',
+        type=int, default=64)
+    parser.add_argument('--keep-alive',
+        help='Seconds an idle persistent connection is kept open, 0 closes every connection after one response',
+        type=float, default=5, metavar='SECONDS')
+    parser.add_argument('--max-requests',
+        help='Number of requests served on one persistent connection before it is closed',
+        type=int, default=100)
+    parser.add_argument('--listing-cache',
+        help='Memory budget in MiB for cached directory listings, 0 disables the cache',
+        type=float, default=64, metavar='MIB')
+    parser.add_argument('--listing-cache-ttl',
+        help='Seconds a cached listing or its ETag is trusted, even if the directory mtime did not change',
+        type=float, default=listing_ttl, metavar='SECONDS')
+    parser.add_argument('--walk-workers',
+        help='Number of threads scanning subdirectories of a recursive listing concurrently',
+        type=int, default=8)
+    parser.add_argument('--stat-workers',
+        help='Number of threads stat-ing the entries of a listing concurrently on slow filesystems, 0 never does',
+        type=int, default=stat_workers)
+    parser.add_argument('--stat-threshold',
+        help='Milliseconds a stat has to take on average for a listing to stat its entries concurrently',
+        type=float, default=stat_threshold * 1000, metavar='MS')
+    parser.add_argument('--upload-expiry',
+        help='Hours an unfinished upload is kept after data last arrived for it, 0 keeps it until it is finished',
+        type=float, default=upload_expiry / 3600, metavar='HOURS')
+    parser.add_argument('--search-index',
+        help='Index the file names of the served tree for ?search, about 400 bytes per entry and process',
+        action='store_true')
+    parser.add_argument('--du',
+        help='Add up directory sizes in the background, shown in listings with ?du',
+        action='store_true')
+    parser.add_argument('--du-interval',
+        help='Seconds between two passes over the served tree for --du',
+        type=float, default=600, metavar='SECONDS')
+    parser.add_argument('--processes',
+        help='Number of server processes sharing the port with SO_REUSEPORT',
+        type=int, default=1)
     parser.add_argument(
         '-v', '--version',
         action='version',
@@ -359,16 +1752,101 @@ def main():
 
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if args.queue_size < 1:
+        parser.error('--queue-size must be at least 1')
+
+    if args.keep_alive < 0:
+        parser.error('--keep-alive must not be negative')
+
+    if args.max_requests < 1:
+        parser.error('--max-requests must be at least 1')
+
+    if args.listing_cache < 0:
+        parser.error('--listing-cache must not be negative')
+
+    if args.walk_workers < 1:
+        parser.error('--walk-workers must be at least 1')
+
+    if args.stat_workers < 0:
+        parser.error('--stat-workers must not be negative')
+
+    if args.stat_threshold < 0:
+        parser.error('--stat-threshold must not be negative')
+
+    if args.upload_expiry < 0:
+        parser.error('--upload-expiry must not be negative')
+
+    if args.processes < 1:
+        parser.error('--processes must be at least 1')
+
+    if args.processes > 1:
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--processes is not supported on this platform')
+
+        if args.deletion_level == 1:
+            parser.error('-d cannot be used with --processes, uploaded files are tracked per process')
+
+    stat_workers = args.stat_workers
+    stat_threshold = args.stat_threshold / 1000
+    upload_expiry = args.upload_expiry * 3600 or None
+    listing_ttl = args.listing_cache_ttl
+
     deletion_level = args.deletion_level
     if deletion_level:
         print('*** Notice: Deletion Level = {} ***'.format(deletion_level))
 
-    acl = [ACLRule(rule) for rule in args.acl]
+    acl = tuple(ACLRule(rule) for rule in args.acl)
     print(acl)
 
     show_my_ip.show()
 
-    bottle.run(host='0.0.0.0', port=args.port)
+    server_options = {
+        'keep_alive': args.keep_alive,
+        'max_requests': args.max_requests,
+        'workers': args.workers,
+    }
+    if args.server == 'thread':
+        server_options.update(queue_size=args.queue_size)
+
+    if args.processes > 1:
+        server_options.update(reuse_port=True)
+
+    def run():
+        # Created per process, threads do not survive fork()
+        global listing_cache
+        global walk_pool
+        global stat_pool
+        global search_index
+        global disk_usage
+        if args.listing_cache:
+            listing_cache = cache.ListingCache(int(args.listing_cache * 1024 * 1024), args.listing_cache_ttl)
+
+        walk_pool = ThreadPoolExecutor(args.walk_workers, thread_name_prefix='hfs-walk')
+
+        if args.stat_workers:
+            stat_pool = ThreadPoolExecutor(args.stat_workers, thread_name_prefix='hfs-stat')
+
+        if args.search_index:
+            search_index = search.SearchIndex()
+            search_index.start()
+
+        if args.du:
+            disk_usage = du.DiskUsage(args.du_interval)
+            disk_usage.start()
+
+        bottle.run(
+            host='0.0.0.0', port=args.port,
+            server=server.engines[args.server],
+            **server_options
+        )
+
+    if args.processes > 1:
+        server.prefork(args.processes, run)
+    else:
+        run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+import base64
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+
+# Digests of uploads (RFC 9530 Content-Digest and Repr-Digest), computed as
+# the data is written. A verified digest is kept in an extended attribute of
+# the file along with its mtime and size, which tell when it went stale, or
+# in memory where the filesystem has no extended attributes. Files are never
+# hashed to answer a request
+
+ALGORITHMS = {
+    'sha-256': hashlib.sha256,
+    'sha-512': hashlib.sha512,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+}
+
+XATTR = 'user.hfs.digest.'
+
+BUFSIZE = 1024 * 1024
+
+# (abspath, algorithm) -> (mtime_ns, size, digest), the FALLBACK_SIZE most
+# recently used
+fallback = OrderedDict()
+fallback_lock = threading.Lock()
+FALLBACK_SIZE = 4096
+
+
+class DigestError(ValueError):
+    pass
+
+
+def parse(text):
+    # 'sha-256=:<base64>:, sha-512=...' -> {'sha-256': b'...'}. A hex value
+    # is taken too, beyond RFC 9530, for the output of sha256sum and the
+    # like. Unknown algorithms are skipped, but not all of them
+    digests = {}
+    for item in text.split(','):
+        key, sep, value = item.partition('=')
+        key = key.strip().lower()
+        value = value.partition(';')[0].strip()
+        if not sep or not value:
+            raise DigestError('Malformed digest "{}"'.format(item.strip()))
+
+        if key not in ALGORITHMS:
+            continue
+
+        try:
+            if len(value) > 1 and value[0] == value[-1] == ':':
+                digests[key] = base64.b64decode(value[1:-1], validate=True)
+            else:
+                digests[key] = bytes.fromhex(value)
+        except ValueError:
+            raise DigestError('Malformed {} value'.format(key))
+
+    if not digests:
+        raise DigestError('No supported algorithm, use one of ' + ', '.join(ALGORITHMS))
+
+    return digests
+
+
+def parse_want(text):
+    # 'sha-256=3, sha-512=10' -> the supported algorithms wanted, most wanted
+    # first
+    wanted = []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        key = key.strip().lower()
+        try:
+            weight = int(weight)
+        except ValueError:
+            continue
+
+        if key in ALGORITHMS and weight > 0:
+            wanted.append((-weight, key))
+
+    return [key for _, key in sorted(wanted)]
+
+
+def format_digest(algorithm, value):
+    return '{}=:{}:'.format(algorithm, base64.b64encode(value).decode('ascii'))
+
+
+class Hasher:
+    # Checks the data against the first of the digests with an algorithm
+    # known here
+    def __init__(self, digests):
+        self.algorithm, self.expected = next(iter(digests.items()))
+        self.hash = ALGORITHMS[self.algorithm]()
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def wrap(self, chunks):
+        for data in chunks:
+            self.hash.update(data)
+            yield data
+
+    def verify(self):
+        value = self.hash.digest()
+        if value != self.expected:
+            raise DigestError('{} digest does not match'.format(self.algorithm))
+
+        return value
+
+
+def hash_file(fpath, hash):
+    # hash: a Hasher, or one of hashlib
+    with open(fpath, 'rb') as f:
+        for data in iter(lambda: f.read(BUFSIZE), b''):
+            hash.update(data)
+
+
+def store(fpath, algorithm, value, st=None):
+    st = st or os.stat(fpath)
+    try:
+        os.setxattr(fpath, XATTR + algorithm, '{} {} {}'.format(st.st_mtime_ns, st.st_size, value.hex()).encode())
+    except (AttributeError, OSError):
+        key = (os.path.abspath(fpath), algorithm)
+        with fallback_lock:
+            fallback[key] = (st.st_mtime_ns, st.st_size, value)
+            fallback.move_to_end(key)
+            if len(fallback) > FALLBACK_SIZE:
+                fallback.popitem(last=False)
+
+
+def load(fpath, algorithm):
+    # The stored digest, None if there is none or the file changed since
+    st = os.stat(fpath)
+    try:
+        mtime, size, value = os.getxattr(fpath, XATTR + algorithm).split()
+        record = (int(mtime), int(size), bytes.fromhex(value.decode('ascii')))
+    except (AttributeError, OSError, ValueError):
+        key = (os.path.abspath(fpath), algorithm)
+        with fallback_lock:
+            record = fallback.get(key)
+            if record is not None:
+                fallback.move_to_end(key)
+
+    if record is None or record[:2] != (st.st_mtime_ns, st.st_size):
+        return None
+
+    return record[2]
+
@@ -0,0 +1,235 @@
+import os
+import queue
+import threading
+import time
+
+from contextlib import suppress
+from stat import S_ISDIR
+
+from hfs import resumable
+
+
+def dir_key(st):
+    return (st.st_dev, st.st_ino)
+
+
+class Usage:
+    # One directory: the files directly in it, validated by its mtime, and
+    # the totals of its whole subtree once they were added up
+    __slots__ = ('version', 'size', 'files', 'subdirs', 'total_size', 'total_files')
+
+    def __init__(self, version, size, files, subdirs):
+        self.version = version
+        self.size = size
+        self.files = files
+        self.subdirs = subdirs
+        self.total_size = None
+        self.total_files = None
+
+
+class DiskUsage:
+    # Apparent sizes (du --apparent-size) and file counts of every directory
+    # below the working directory, added up by a background thread. A pass
+    # only scans the directories whose mtime changed since the last one,
+    # the others keep their sums; uploads and deletions through the server
+    # adjust the totals up the ancestor chain right away
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.usages = {}
+        self.requests = queue.Queue()
+        self.requested = set()
+
+    def start(self):
+        threading.Thread(target=self.run, name='hfs-du', daemon=True).start()
+
+    def run(self):
+        while True:
+            seen = set()
+            self.measure('.', seen)
+            with self.lock:
+                for key in set(self.usages) - seen:
+                    del self.usages[key]
+
+            deadline = time.monotonic() + self.interval
+            while True:
+                try:
+                    dpath = self.requests.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                self.refresh(dpath)
+                with self.lock:
+                    self.requested.discard(dpath)
+
+    def get(self, dpath, st):
+        # (total size, total files), or (None, None) while it is measured
+        with self.lock:
+            usage = self.usages.get(dir_key(st))
+            if usage is not None and usage.version == st.st_mtime_ns and usage.total_size is not None:
+                return usage.total_size, usage.total_files
+
+            if dpath not in self.requested:
+                self.requested.add(dpath)
+                self.requests.put(dpath)
+
+        return None, None
+
+    def visit(self, dpath, seen):
+        try:
+            st = os.stat(dpath)
+        except OSError:
+            return None
+
+        key = dir_key(st)
+        seen.add(key)
+        with self.lock:
+            usage = self.usages.get(key)
+            if usage is not None and usage.version == st.st_mtime_ns:
+                return usage
+
+        size = files = 0
+        subdirs = []
+        with suppress(OSError), os.scandir(dpath) as entries:
+            for entry in entries:
+                if resumable.is_upload(entry.name):
+                    continue
+
+                with suppress(OSError):
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+
+        usage = Usage(st.st_mtime_ns, size, files, subdirs)
+        with self.lock:
+            self.usages[key] = usage
+
+        return usage
+
+    def measure(self, dpath, seen):
+        # Post-order walk adding up the subtree of dpath
+        top = self.visit(dpath, seen)
+        if top is None:
+            return None
+
+        stack = [[dpath, top, list(top.subdirs), top.size, top.files]]
+        while stack:
+            frame = stack[-1]
+            path, usage, pending = frame[:3]
+            if pending:
+                subpath = os.path.join(path, pending.pop())
+                child = self.visit(subpath, seen)
+                if child is not None:
+                    stack.append([subpath, child, list(child.subdirs), child.size, child.files])
+
+                continue
+
+            stack.pop()
+            with self.lock:
+                usage.total_size, usage.total_files = frame[3], frame[4]
+
+            if stack:
+                stack[-1][3] += frame[3]
+                stack[-1][4] += frame[4]
+
+        return top
+
+    def refresh(self, dpath):
+        # Measures dpath again and passes the difference on to its ancestors;
+        # a directory unknown so far is not counted in them yet
+        with self.lock:
+            usage = self.lookup(dpath)
+            before = (usage.total_size, usage.total_files) if usage is not None else (0, 0)
+
+        usage = self.measure(dpath, set())
+        if usage is None or before[0] is None or dpath == '.':
+            return
+
+        with self.lock:
+            self.adjust_ancestors(
+                os.path.dirname(dpath) or '.',
+                usage.total_size - before[0],
+                usage.total_files - before[1],
+            )
+
+    def lookup(self, dpath):
+        try:
+            return self.usages.get(dir_key(os.stat(dpath)))
+        except OSError:
+            return None
+
+    def version(self, dpath):
+        # To pass to added() for a file about to be created in dpath
+        try:
+            return os.stat(dpath).st_mtime_ns
+        except OSError:
+            return None
+
+    def measure_item(self, fpath):
+        # What removing fpath takes off its ancestors, None if unknown
+        try:
+            st = os.lstat(fpath)
+        except OSError:
+            return None
+
+        before = self.version(os.path.dirname(os.path.normpath(fpath)) or '.')
+        if not S_ISDIR(st.st_mode):
+            return (st.st_size, 1, False, before)
+
+        with self.lock:
+            usage = self.usages.get(dir_key(st))
+            if usage is None or usage.total_size is None:
+                return None
+
+            return (usage.total_size, usage.total_files, True, before)
+
+    def added(self, fpath, before=None):
+        # before: the version of the directory before fpath was created in it
+        with suppress(OSError):
+            self.update(fpath, os.lstat(fpath).st_size, 1, False, before)
+
+    def removed(self, fpath, measured):
+        if measured is not None:
+            self.update(fpath, -measured[0], -measured[1], *measured[2:])
+
+    def update(self, fpath, size, files, isdir, before):
+        dpath = os.path.dirname(os.path.normpath(fpath)) or '.'
+        name = os.path.basename(fpath)
+        with self.lock:
+            try:
+                st = os.stat(dpath)
+            except OSError:
+                return
+
+            usage = self.usages.get(dir_key(st))
+            if usage is None:
+                return
+
+            # The sums stay valid through a change of ours only if they were
+            # before it, otherwise the next pass measures the directory
+            if before is not None and usage.version == before:
+                usage.version = st.st_mtime_ns
+
+            if isdir:
+                with suppress(ValueError):
+                    usage.subdirs.remove(name)
+            else:
+                usage.size += size
+                usage.files += files
+
+            self.adjust_ancestors(dpath, size, files)
+
+    def adjust_ancestors(self, dpath, size, files):
+        while True:
+            usage = self.lookup(dpath)
+            if usage is None or usage.total_size is None:
+                return
+
+            usage.total_size += size
+            usage.total_files += files
+            if dpath == '.':
+                return
+
+            dpath = os.path.dirname(dpath) or '.'
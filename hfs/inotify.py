@@ -0,0 +1,126 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+IN_CHANGES = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+    IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+
+    return libc
+
+
+class Watcher:
+    # Calls callback(path, name, mask) from a background thread for every
+    # event on a watched directory, and callback(None, None, IN_Q_OVERFLOW)
+    # when the kernel dropped events
+    def __init__(self, libc, fd, callback, mask):
+        self.libc = libc
+        self.fd = fd
+        self.callback = callback
+        self.mask = mask
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.wds = {}
+        self.thread = threading.Thread(target=self.read_events, name='hfs-inotify', daemon=True)
+        self.thread.start()
+
+    def add(self, path):
+        with self.lock:
+            if path in self.wds:
+                return True
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask | IN_ONLYDIR)
+            if wd < 0:
+                # ENOSPC: out of watches, the caller falls back to polling
+                return False
+
+            self.wds[path] = wd
+            self.paths[wd] = path
+            return True
+
+    def remove(self, path):
+        with self.lock:
+            wd = self.wds.pop(path, None)
+            if wd is None:
+                return
+
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.callback(None, None, mask)
+                    continue
+
+                with self.lock:
+                    path = self.paths.get(wd)
+                    if mask & IN_IGNORED and path is not None:
+                        del self.paths[wd]
+                        del self.wds[path]
+
+                if path is not None:
+                    self.callback(path, name, mask)
+
+
+def watcher(callback, mask=IN_CHANGES):
+    # Returns None where inotify is not available
+    libc = load_libc()
+    if libc is None:
+        return None
+
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        return None
+
+    return Watcher(libc, fd, callback, mask)
@@ -0,0 +1,133 @@
+import re
+
+from contextlib import suppress
+
+from urllib.parse import unquote
+
+# Longest header block of a part
+MAX_HEADER = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def get_boundary(content_type):
+    # None unless content_type is multipart/form-data with a boundary
+    mime, _, options = content_type.partition(';')
+    if mime.strip().lower() != 'multipart/form-data':
+        return None
+
+    boundary = parse_options(options).get('boundary')
+    if not boundary or len(boundary) > 70:
+        return None
+
+    return boundary.encode('latin-1', 'replace')
+
+
+def parse_options(text):
+    # '; name="upload"; filename="a.txt"' -> {'name': 'upload', 'filename': 'a.txt'}
+    options = {}
+    for m in re.finditer(r';?\s*([^\s=;]+)\s*=\s*("(?:\\.|[^"\\])*"|[^;]*)', text):
+        key, value = m.group(1).lower(), m.group(2).strip()
+        if value.startswith('"'):
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+
+        options[key] = value
+
+    return options
+
+
+class Part:
+    __slots__ = ('headers', 'name', 'filename', 'data')
+
+    def __init__(self, headers, data):
+        self.headers = headers
+        self.data = data
+        options = parse_options(headers.get('content-disposition', '').partition(';')[2])
+        self.name = options.get('name')
+        self.filename = options.get('filename')
+        if 'filename*' in options:
+            # RFC 5987: charset'language'percent-encoded, filename stays if
+            # the charset is unknown
+            charset, _, value = options['filename*'].partition("'")
+            with suppress(LookupError):
+                self.filename = unquote(value.partition("'")[2], encoding=charset or 'utf-8', errors='surrogateescape')
+
+    def __iter__(self):
+        return self.data
+
+
+class MultipartParser:
+    # multipart/form-data (RFC 7578) read from an iterator of byte chunks,
+    # one part after the other: the data of a part is passed on as it comes,
+    # holding back no more than the length of the delimiter. Whatever a
+    # caller leaves unread of a part is skipped
+    def __init__(self, chunks, boundary):
+        self.chunks = iter(chunks)
+        self.delimiter = b'\r\n--' + boundary
+        # The first delimiter has no line break in front of it
+        self.buf = b'\r\n'
+
+    def __iter__(self):
+        for _ in self.iter_data():
+            pass  # Preamble
+
+        while True:
+            while len(self.buf) < 2:
+                self.fill()
+
+            if self.buf.startswith(b'--'):
+                return  # Close delimiter, the epilogue is ignored
+
+            part = Part(self.read_headers(), self.iter_data())
+            yield part
+            for _ in part.data:
+                pass
+
+    def fill(self):
+        chunk = next(self.chunks, b'')
+        if not chunk:
+            raise MultipartError('Unexpected end of the request body')
+
+        self.buf += chunk
+
+    def read_headers(self):
+        # The rest of the delimiter line, then header lines up to a blank one
+        while True:
+            end = self.buf.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+
+            if len(self.buf) > MAX_HEADER:
+                raise MultipartError('Part headers too long')
+
+            self.fill()
+
+        lines, self.buf = self.buf[:end].split(b'\r\n')[1:], self.buf[end + 4:]
+        headers = {}
+        for line in lines:
+            key, sep, value = line.decode('utf-8', 'surrogateescape').partition(':')
+            if not sep:
+                raise MultipartError('Malformed part header')
+
+            headers[key.strip().lower()] = value.strip()
+
+        return headers
+
+    def iter_data(self):
+        # Up to the next delimiter, which is consumed
+        keep = len(self.delimiter) - 1
+        while True:
+            end = self.buf.find(self.delimiter)
+            if end >= 0:
+                data, self.buf = self.buf[:end], self.buf[end + len(self.delimiter):]
+                if data:
+                    yield data
+                return
+
+            if len(self.buf) > keep:
+                data, self.buf = self.buf[:-keep], self.buf[-keep:]
+                yield data
+
+            self.fill()
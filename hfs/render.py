@@ -0,0 +1,223 @@
+import re
+
+from hfs.bottle import html_escape
+
+SPECIAL = re.compile('[&<>"\']')
+
+# Listings rendered without the template engine: the static parts are built
+# once, and every row is a single format() call. tests/test_render.py pins
+# the output to what the templates it replaced produced
+
+RULE = '-' * 79 + '\n'
+DOUBLE_RULE = '=' * 79 + '\n'
+
+HTML_HEAD = '''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>hfs - {host}</title>
+    <meta name="viewport" content="width=device-width">
+    <link rel="stylesheet" href="/static/main.css">
+    <link rel="shortcut icon" href="data:image/x-icon;," type="image/x-icon">
+    <script src="/static/jquery.min.js"></script>
+    <script src="/static/qrcode.js"></script>
+    <script src="/static/main.js"></script>
+  </head>
+  <body>
+    <h2>
+      <a href="/">{host}</a>
+{ancestors}\
+    </h2>
+    <div id="file-browser">
+'''
+
+HTML_ANCESTOR = '''\
+      <span>/</span>
+      <a href="{}">{}</a>
+'''
+
+HTML_HIDDEN_HEAD = '''\
+      <div id="widget-show-hidden-files" class="widget widget-show">[&#8594; show hidden files]</div>
+
+      <div id="hidden-files" class="hidden">
+        <div class="widget widget-hide" colspan="3">[&#8595; hide hidden files]</div>
+        <table><tbody>
+<table class="flist"><tbody>
+'''
+
+HTML_HIDDEN_TAIL = '''\
+</tbody></table>
+        </tbody></table>
+        <div class="widget widget-hide"><td>[&#8593; hide hidden files]</div>
+      </div>
+'''
+
+HTML_SHOWN_HEAD = '''\
+      <p>
+<table class="flist"><tbody>
+'''
+
+HTML_TAIL = '''\
+</tbody></table>
+      </p>
+{next_page}\
+    </div>
+    <div id="qrcode"></div>
+    <hr>
+    <h2>Upload file:</h2>
+    <input type="file" id="file" name="upload" multiple>
+    <input id="curdir" type="hidden" value="{curdir}">
+    <table id="pending-files">
+    </table>
+
+    <button id="btn-upload">Upload</button><br>
+    <div id="message"></div>
+  </body>
+</html>
+'''
+
+HTML_NEXT_PAGE = '''\
+      <p><a class="widget" href="{}">[next page &#8594;]</a></p>
+'''
+
+HTML_ROW = '''\
+  <tr class="fitem">
+    <td>
+{}\
+    </td>
+    <td>{}</td>
+    <td>{}</td>
+    <td><a href="/{}/{}">{}</a><td>
+  </tr>
+'''
+
+HTML_DELETE = '''\
+      <button class="deletion" onclick="file_delete('/{}/{}')">
+        Delete
+      </button>
+'''
+
+# ?virtual: the entries are fetched and drawn by static/virtual.js
+HTML_VIRTUAL = '''\
+      <div id="virtual-tools">
+        <span id="widget-show-hidden-files" class="widget widget-show">[&#8594; show hidden files]</span>
+        <span id="widget-hide-hidden-files" class="widget widget-hide hidden">[&#8593; hide hidden files]</span>
+        <input id="virtual-filter" type="search" placeholder="filter">
+        <select id="virtual-sort">
+          <option value="name">name</option>
+          <option value="size">size</option>
+          <option value="mtime">mtime</option>
+        </select>
+        <select id="virtual-order">
+          <option value="asc">asc</option>
+          <option value="desc">desc</option>
+        </select>
+        <span id="virtual-status"></span>
+      </div>
+      <div id="virtual-list"><div id="virtual-rows"></div></div>
+      <script src="/static/virtual.js"></script>
+'''
+
+HTML_DU_SIZE = '''\
+{}</td>
+    <td>{}'''
+
+
+def escape(text):
+    # Most names have nothing to escape
+    return html_escape(text) if SPECIAL.search(text) else text
+
+
+def mtime_texts():
+    # FileItem.mtime shows whole seconds, items from the same second share
+    # the text; the last microsecond may round up to the next second
+    texts = {}
+
+    def mtime_text(x):
+        t = x.stat.st_mtime
+        sec = int(t)
+        if not 0 <= t - sec < 0.999999:
+            return x.mtime
+
+        text = texts.get(sec)
+        if text is None:
+            text = texts[sec] = x.mtime
+
+        return text
+
+    return mtime_text
+
+
+def html_head(host, ancestors_dlist):
+    return HTML_HEAD.format(
+        host=escape(host),
+        ancestors=''.join(
+            HTML_ANCESTOR.format(escape(x.dpath), escape(x.dname))
+            for x in ancestors_dlist
+        ),
+    )
+
+
+def html_tail(curdir, next_url):
+    return HTML_TAIL.format(
+        curdir=escape(curdir),
+        next_page=HTML_NEXT_PAGE.format(escape(next_url)) if next_url else '',
+    )
+
+
+def virtual_page(host, ancestors_dlist, curdir):
+    return html_head(host, ancestors_dlist) + HTML_VIRTUAL + HTML_SHOWN_HEAD + html_tail(curdir, None)
+
+
+def html_rows(flist, curdir, du):
+    curdir = escape(curdir)
+    mtime_text = mtime_texts()
+    rows = []
+    for x in flist:
+        fname = escape(x.fname)
+        rows.append(HTML_ROW.format(
+            HTML_DELETE.format(curdir, fname) if x.deletable else '',
+            mtime_text(x),
+            HTML_DU_SIZE.format(x.size_text, x.file_count) if du else x.size,
+            curdir,
+            fname,
+            fname + '/' if x.isdir else fname,
+        ))
+
+    return ''.join(rows)
+
+
+def curl_head(host, ancestors_dlist):
+    path = '/'.join(x.dname for x in ancestors_dlist)
+    return '{}{}/{}\n{}'.format(DOUBLE_RULE, escape(host), escape(path), RULE)
+
+
+def curl_tail(host, next_url):
+    if next_url:
+        return '{}next page: {}{}\n'.format(DOUBLE_RULE, host, next_url)
+
+    return DOUBLE_RULE
+
+
+def curl_rows(flist, size_width, files_width, du):
+    # Only the names can hold characters to escape, rows are escaped at once
+    mtime_text = mtime_texts()
+    if du:
+        return escape(''.join([
+            '{} | {} | {} | {}\n'.format(
+                mtime_text(x),
+                x.size_text.ljust(size_width),
+                x.file_count.ljust(files_width),
+                x.ftext,
+            )
+            for x in flist
+        ]))
+
+    return escape(''.join([
+        '{} | {} | {}\n'.format(mtime_text(x), str(x.size).ljust(size_width), x.ftext)
+        for x in flist
+    ]))
+
+
+def pipe_rows(flist):
+    return escape(''.join([x.ftext + '\n' for x in flist]))
@@ -0,0 +1,317 @@
+import json
+import os
+import secrets
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+# Uploads sent in pieces: the data goes into a hidden file in the target
+# directory, and its expected length and name into a second one, so that an
+# upload survives restarts of the server. The upload is moved to its name
+# once it is complete. A file can also be sent in parts at once: its upload
+# is then allocated in full up front, each part is an upload of its own that
+# writes its range of it in place, and the file is finished once all parts
+# are there
+
+PREFIX = '.hfs-upload-'
+STATE = '.json'
+
+# Paths locked within this process where there is no flock()
+held = set()
+held_changed = threading.Condition()
+
+# dpath -> when its abandoned uploads were last looked for
+expired = {}
+expired_lock = threading.Lock()
+EXPIRE_INTERVAL = 600
+
+
+class UploadConflict(Exception):
+    # The offset does not match, or another request is appending
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+
+class UploadTooLong(Exception):
+    pass
+
+
+class UploadGone(Exception):
+    # Finished, or dropped meanwhile
+    def __init__(self, upath):
+        super().__init__(upath)
+        self.upath = upath
+
+
+class InvalidParts(ValueError):
+    pass
+
+
+def create(dpath, name, length, digest=None, parts=False):
+    # With parts, the data is written by the parts created with create_part()
+    upath = new_upath(dpath)
+    with open(upath + STATE, 'x') as f:
+        json.dump({'name': name, 'length': length, 'digest': digest, 'parts': parts}, f)
+
+    with open(upath, 'xb') as f:
+        if parts:
+            allocate(f, length)
+
+    return upath
+
+
+def create_part(target, start, length):
+    # A part has no data of its own, it writes to the range of target from
+    # start; how far it got is kept in its state
+    upath = new_upath(os.path.dirname(target))
+    with open(upath + STATE, 'x') as f:
+        json.dump({'partial': True, 'target': target, 'start': start, 'length': length, 'offset': 0}, f)
+
+    return upath
+
+
+def is_upload(name):
+    # The files of uploads in progress, left out of listings, searches and
+    # sizes: their names are what lets a client continue or drop them
+    return name.startswith(PREFIX)
+
+
+def new_upath(dpath):
+    return os.path.normpath(os.path.join(dpath, PREFIX + secrets.token_hex(16)))
+
+
+def allocate(f, length):
+    # Sparse where the filesystem cannot reserve the blocks
+    if hasattr(os, 'posix_fallocate') and length:
+        try:
+            os.posix_fallocate(f.fileno(), 0, length)
+            return
+        except OSError:
+            pass
+
+    f.truncate(length)
+
+
+def get_state(upath):
+    # {'offset', 'length', 'name', 'digest', 'parts'}, or for a part
+    # {'offset', 'length', 'partial', 'target', 'start'}; None if upath is
+    # no upload in progress. An upload sent in parts is at offset 0 until
+    # it is finished
+    if not os.path.basename(upath).startswith(PREFIX) or upath.endswith(STATE):
+        return None
+
+    try:
+        with open(upath + STATE) as f:
+            state = {'partial': False, 'digest': None, 'parts': False}
+            state.update(json.load(f))
+
+        if not state['partial']:
+            state['offset'] = 0 if state['parts'] else os.path.getsize(upath)
+
+        return state
+    except (OSError, ValueError):
+        return None
+
+
+def append(upath, offset, length, chunks, complete):
+    # Appends chunks to the data, which has to end at offset, and returns
+    # the new offset. What arrived is kept if chunks break off; complete()
+    # is called while other requests are still locked out once all is there
+    with locked(upath, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            raise UploadConflict(f.tell())
+
+        for data in chunks:
+            if offset + len(data) > length:
+                raise UploadTooLong()
+
+            f.write(data)
+            offset += len(data)
+
+        f.flush()
+        if offset == length:
+            complete()
+
+    return offset
+
+
+def write_part(upath, offset, chunks):
+    # Writes chunks to the range of the part upath in its target from offset,
+    # where the part has to end so far, and returns the new offset. Data
+    # written but not yet counted is only written again on a retry
+    with locked(upath + STATE, 'r+') as f:
+        state = json.load(f)
+        if state['offset'] != offset:
+            raise UploadConflict(state['offset'])
+
+        try:
+            with open(state['target'], 'r+b') as target:
+                for data in chunks:
+                    if offset + len(data) > state['length']:
+                        raise UploadTooLong()
+
+                    write_at(target, data, state['start'] + offset)
+                    offset += len(data)
+
+        except FileNotFoundError:
+            raise UploadGone(upath)
+
+        finally:
+            if offset != state['offset']:
+                state['offset'] = offset
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+
+    return offset
+
+
+def write_at(f, data, position):
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, position)
+            view = view[written:]
+            position += written
+
+    else:
+        f.seek(position)
+        f.write(data)
+
+
+def finish_parts(upaths, complete):
+    # Calls complete(target, state) for the upload the parts upaths fill in
+    # this order, then drops the parts. Requests finishing the same upload
+    # wait for each other, the later ones find it gone
+    first = get_state(upaths[0])
+    if first is None or not first['partial']:
+        raise UploadGone(upaths[0])
+
+    target = first['target']
+    with locked(target, 'rb', wait=True):
+        state = get_state(target)
+        if state is None:
+            raise UploadGone(target)
+
+        end = 0
+        for upath in upaths:
+            part = get_state(upath)
+            if part is None:
+                raise UploadGone(upath)
+
+            if not part['partial'] or part['target'] != target or part['start'] != end:
+                raise InvalidParts('"{}" is not the next part of the upload'.format(upath))
+
+            if part['offset'] != part['length']:
+                raise UploadConflict(part['offset'])
+
+            end += part['length']
+
+        if end != state['length']:
+            raise InvalidParts('The parts do not make up the upload')
+
+        complete(target, state)
+
+    for upath in upaths:
+        discard(upath)
+
+
+def terminate(upath):
+    # Drops an upload, unless a request is writing to it; the parts of an
+    # upload sent in parts find it gone
+    state = get_state(upath)
+    if state is None:
+        raise UploadGone(upath)
+
+    with locked(upath + STATE if state['partial'] else upath, 'rb'):
+        discard(upath)
+
+
+def expire(dpath, max_age):
+    # Drops the uploads in dpath nothing was written to for max_age seconds,
+    # looked for at most every EXPIRE_INTERVAL per directory
+    now = time.time()
+    with expired_lock:
+        if now - expired.get(dpath, 0) < EXPIRE_INTERVAL:
+            return
+
+        expired[dpath] = now
+
+    mtimes = {}
+    with os.scandir(dpath) as entries:
+        for entry in entries:
+            if not entry.name.startswith(PREFIX):
+                continue
+
+            upath = os.path.normpath(os.path.join(dpath, entry.name[:-len(STATE)] if entry.name.endswith(STATE) else entry.name))
+            try:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+
+            mtimes[upath] = max(mtime, mtimes.get(upath, 0))
+
+    for upath, mtime in mtimes.items():
+        if now - mtime > max_age:
+            try:
+                terminate(upath)
+            except (UploadGone, UploadConflict):
+                pass
+
+
+@contextmanager
+def locked(path, mode, wait=False):
+    # path opened and locked against other requests until it is closed,
+    # also those of the other --processes; within this process only without
+    # flock() (Windows, which has no --processes either)
+    try:
+        f = open(path, mode)
+    except FileNotFoundError:
+        raise UploadGone(path)
+
+    with f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict(None)
+
+            yield f
+            return
+
+        with held_changed:
+            while path in held:
+                if not wait:
+                    raise UploadConflict(None)
+
+                held_changed.wait()
+
+            held.add(path)
+
+        try:
+            yield f
+        finally:
+            with held_changed:
+                held.remove(path)
+                held_changed.notify_all()
+
+
+def finish(upath, fpath):
+    os.replace(upath, fpath)
+    os.remove(upath + STATE)
+
+
+def discard(upath):
+    for path in (upath, upath + STATE):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
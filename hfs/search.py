@@ -0,0 +1,286 @@
+import os
+import threading
+
+from contextlib import suppress
+from stat import S_ISDIR
+
+from hfs import inotify
+from hfs import resumable
+
+IN_TREE = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+
+GRAM = 3
+
+
+def trigrams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def join_path(dpath, name):
+    return name if dpath == '.' else dpath + '/' + name
+
+
+class Node:
+    # A directory; children maps names to a Node for subdirectories and to
+    # None for everything else. grams holds the trigrams of the children
+    # names, it may keep some of removed children until the next build
+    __slots__ = ('name', 'parent', 'children', 'grams')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.grams = set()
+
+    @property
+    def path(self):
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+
+        return '/'.join(reversed(parts)) or '.'
+
+    def under(self, top):
+        node = self.parent
+        while node is not None:
+            if node is top:
+                return True
+
+            node = node.parent
+
+        return False
+
+
+class SearchIndex:
+    # Every name below the working directory as a tree of directories, plus
+    # the trigrams of the lowercased names, each mapped to the directories
+    # holding a name that contains it. Paths are relative, without "./"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = None
+        self.grams = {}
+        self.backlog = None
+        # Directories being scanned for add(), with the changes below them
+        # that wait for the scan to be merged
+        self.scanning = {}
+        self.out_of_watches = False
+        self.watcher = inotify.watcher(self.on_event, IN_TREE)
+
+    def start(self):
+        threading.Thread(target=self.build, name='hfs-search', daemon=True).start()
+
+    def build(self):
+        with self.lock:
+            if self.backlog is not None:
+                return
+
+            # Changes seen during the scan are applied to its result
+            self.backlog = []
+
+        tree = Node('', None)
+        grams = {}
+        self.scan('.', tree, grams)
+
+        with self.lock:
+            self.tree = tree
+            self.grams = grams
+            backlog, self.backlog = self.backlog, None
+            for change, args in backlog:
+                self.apply(change, args)
+
+    def scan(self, dpath, node, grams):
+        stack = [(dpath, node)]
+        while stack:
+            dpath, node = stack.pop()
+            self.watch(dpath)
+            with suppress(OSError), os.scandir(dpath) as entries:
+                for entry in entries:
+                    if resumable.is_upload(entry.name):
+                        continue
+
+                    child = Node(entry.name, node) if entry.is_dir(follow_symlinks=False) else None
+                    child = self.insert(node, entry.name, child, grams)
+                    if child is not None:
+                        stack.append((join_path(dpath, entry.name), child))
+
+    def watch(self, dpath):
+        if self.watcher is None or self.watcher.add(dpath) or self.out_of_watches:
+            return
+
+        self.out_of_watches = True
+        print('*** Notice: out of inotify watches, the search index only sees uploads and deletions below {} ***'.format(dpath))
+
+    def insert(self, parent, name, node, grams):
+        # node: a Node for a directory, None for anything else
+        if name in parent.children:
+            return parent.children[name]
+
+        parent.children[name] = node
+        for gram in trigrams(name.lower()) - parent.grams:
+            parent.grams.add(gram)
+            grams.setdefault(gram, set()).add(parent)
+
+        return node
+
+    def discard(self, parent, name):
+        stack = [parent.children.pop(name)]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+
+            for gram in node.grams:
+                nodes = self.grams[gram]
+                nodes.discard(node)
+                if not nodes:
+                    del self.grams[gram]
+
+            if self.watcher is not None:
+                self.watcher.remove(node.path)
+
+            stack.extend(node.children.values())
+
+    def lookup(self, path):
+        # The directory at path, or None
+        node = self.tree
+        if path == '.':
+            return node
+
+        for name in path.split('/'):
+            node = node.children.get(name)
+            if node is None:
+                return None
+
+        return node
+
+    def add(self, path):
+        # A new directory is scanned without the lock, and merged into the
+        # index with the changes below it seen meanwhile
+        path = os.path.normpath(path)
+        if resumable.is_upload(os.path.basename(path)):
+            return
+
+        try:
+            isdir = S_ISDIR(os.lstat(path).st_mode)
+        except OSError:
+            return
+
+        if not isdir:
+            self.change(self.do_add, path, None, None)
+            return
+
+        with self.lock:
+            if self.tree is None and self.backlog is None:
+                return
+
+            self.scanning.setdefault(path, [])
+
+        node = Node(os.path.basename(path), None)
+        grams = {}
+        self.scan(path, node, grams)
+        with self.lock:
+            deferred = self.scanning.pop(path)
+            self.apply(self.do_add, (path, node, grams))
+            for change, args in deferred:
+                self.apply(change, args)
+
+    def remove(self, path):
+        self.change(self.do_remove, os.path.normpath(path))
+
+    def change(self, change, *args):
+        with self.lock:
+            self.apply(change, args)
+
+    def apply(self, change, args):
+        # args[0] is the path changed
+        deferred = self.find_scanning(os.path.dirname(args[0])) if self.scanning else None
+        if deferred is not None:
+            deferred.append((change, args))
+        elif self.backlog is not None:
+            self.backlog.append((change, args))
+        elif self.tree is not None:
+            change(*args)
+
+    def find_scanning(self, dpath):
+        while dpath:
+            if dpath in self.scanning:
+                return self.scanning[dpath]
+
+            dpath = os.path.dirname(dpath)
+
+        return None
+
+    def do_add(self, path, node, grams):
+        # node and grams: the scanned directory at path, None for anything
+        # else
+        parent = self.lookup(os.path.dirname(path) or '.')
+        if parent is None:
+            return
+
+        name = os.path.basename(path)
+        if name in parent.children:
+            if (parent.children[name] is None) == (node is None):
+                return
+
+            self.discard(parent, name)
+
+        if node is not None:
+            node.parent = parent
+            for gram, nodes in grams.items():
+                self.grams.setdefault(gram, set()).update(nodes)
+
+        self.insert(parent, name, node, self.grams)
+
+    def do_remove(self, path):
+        parent = self.lookup(os.path.dirname(path) or '.')
+        if parent is not None and os.path.basename(path) in parent.children:
+            self.discard(parent, os.path.basename(path))
+
+    def on_event(self, dpath, name, mask):
+        if dpath is None:
+            # The kernel dropped events, start over
+            self.start()
+            return
+
+        path = join_path(dpath, name)
+        if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            self.add(path)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.remove(path)
+
+    def search(self, dpath, pattern):
+        # Paths below dpath whose name contains pattern, ignoring case;
+        # None until the first build is complete
+        pattern = pattern.lower()
+        with self.lock:
+            if self.tree is None:
+                return None
+
+            top = self.lookup(os.path.normpath(dpath))
+            if top is None:
+                return []
+
+            if len(pattern) < GRAM:
+                nodes = self.iter_subtree(top)
+            else:
+                postings = sorted((self.grams.get(gram, ()) for gram in trigrams(pattern)), key=len)
+                nodes = set(postings[0]).intersection(*postings[1:])
+                nodes = (x for x in nodes if x is top or x.under(top))
+
+            paths = []
+            for node in nodes:
+                found = [name for name in node.children if pattern in name.lower()]
+                if found:
+                    dpath = node.path
+                    paths.extend(join_path(dpath, name) for name in found)
+
+            return sorted(paths)
+
+    def iter_subtree(self, top):
+        stack = [top]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(x for x in node.children.values() if x is not None)
@@ -0,0 +1,795 @@
+import asyncio
+import email.utils
+import os
+import queue
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from urllib.parse import unquote
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from hfs import bottle
+from hfs.constants import __version__
+
+SERVER_SOFTWARE = 'hfs/' + __version__
+
+
+class RequestBody:
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def drain(self, limit):
+        # Skip what the app left unread, so the next request starts at its request line
+        if self.remaining > limit:
+            return False
+
+        while self.remaining:
+            if not self.read(1 << 16):
+                return False
+
+        return True
+
+
+class FileRange:
+    def __init__(self, fp, offset, count):
+        self.fp = fp
+        self.offset = offset
+        self.count = count
+        self.remaining = count
+        fp.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.fp.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+
+class FileWrapper:
+    def __init__(self, filelike, blksize=1 << 20):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        read = self.filelike.read
+        while True:
+            data = read(self.blksize)
+            if not data:
+                return
+            yield data
+
+    def span(self, content_length):
+        # The underlying file, offset and byte count to hand to sendfile
+        f = self.filelike
+        if isinstance(f, FileRange):
+            return f.fp, f.fp.tell(), f.remaining
+
+        try:
+            f.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+        if content_length is None:
+            return None
+
+        return f, f.tell(), int(content_length)
+
+
+class KeepAliveServerHandler(ServerHandler):
+    server_software = SERVER_SOFTWARE
+    http_version = '1.1'
+    wsgi_file_wrapper = FileWrapper
+    chunked = False
+    framing = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        handler = self.request_handler
+        code = int(self.status.split()[0])
+        has_body = (
+            self.environ['REQUEST_METHOD'] != 'HEAD' and
+            code not in (204, 304) and code >= 200
+        )
+
+        if has_body and 'Content-Length' not in self.headers:
+            if handler.request_version == 'HTTP/1.1':
+                self.chunked = True
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                handler.close_connection = True
+
+        if handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif handler.request_version != 'HTTP/1.1':
+            self.headers['Connection'] = 'keep-alive'
+
+    def sendfile(self):
+        if not hasattr(os, 'sendfile'):
+            return False
+
+        span = self.result.span(self.headers.get('Content-Length'))
+        if span is None:
+            return False
+
+        f, offset, count = span
+        if not self.headers_sent:
+            self.send_headers()
+
+        out_fd = self.request_handler.connection.fileno()
+        while count > 0:
+            sent = os.sendfile(out_fd, f.fileno(), offset, min(count, 1 << 30))
+            if not sent:
+                # The file shrank, the promised Content-Length can not be kept
+                self.request_handler.close_connection = True
+                break
+
+            offset += sent
+            count -= sent
+            self.bytes_sent += sent
+
+        return True
+
+    def send_headers(self):
+        super().send_headers()
+        self.framing = self.chunked
+
+    def _write(self, data):
+        if self.framing and data:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        super()._write(data)
+
+    def finish_content(self):
+        super().finish_content()
+        if self.framing:
+            self.framing = False
+            super()._write(b'0\r\n\r\n')
+            self._flush()
+
+
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    quiet = False
+    keep_alive = 5
+    max_requests = 100
+
+    def address_string(self):  # Prevent reverse DNS lookups please.
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        if not self.quiet:
+            return super().log_request(*args, **kwargs)
+
+    def setup(self):
+        super().setup()
+        # The head and the chunks of a response go out in separate writes
+        with suppress(OSError):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        self.served = 0
+        self.resume()
+
+    def resume(self):
+        # Serves the requests that have arrived, the connection then waits
+        # for the next one off the worker
+        self.handle_one_request()
+        while not self.close_connection and self.has_input():
+            self.handle_one_request()
+
+    def has_input(self):
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(None)
+
+    def finish(self):
+        # The server closes the connection when it is done with it
+        pass
+
+    def close(self):
+        super().finish()
+
+    def handle_one_request(self):
+        self.close_connection = True
+        self.connection.settimeout(self.keep_alive or None)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            return
+        finally:
+            self.connection.settimeout(None)
+
+        if not self.raw_requestline:
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        self.served += 1
+        if not self.keep_alive or self.served >= self.max_requests:
+            self.close_connection = True
+
+        environ = self.get_environ()
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # The app may stop reading anywhere inside the chunks
+            body = self.rfile
+            self.close_connection = True
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = -1
+
+            if length < 0:
+                self.close_connection = True
+                self.send_error(400, 'Bad Content-Length')
+                return
+
+            body = RequestBody(self.rfile, length)
+        environ['wsgi.input'] = body
+
+        handler = KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), environ,
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        if not self.close_connection and not self.drain(body):
+            self.close_connection = True
+
+    def drain(self, body):
+        # A body that does not arrive in time ends the connection
+        self.connection.settimeout(self.keep_alive)
+        try:
+            return body.drain(bottle.BaseRequest.MEMFILE_MAX)
+        except socket.timeout:
+            return False
+        finally:
+            self.connection.settimeout(None)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    reuse_port = False
+
+    def __init__(self, server_address, handler_cls, workers, queue_size):
+        super().__init__(server_address, handler_cls)
+        # Connections wait for data in the selector, a worker only takes one
+        # with a request to read. Beyond the queue depth they wait there
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.selector = selectors.DefaultSelector()
+        self.arrivals = []
+        self.arrivals_lock = threading.Lock()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.watcher = threading.Thread(target=self.watch, name='hfs-watcher', daemon=True)
+        self.watcher.start()
+        self.workers = [
+            threading.Thread(target=self.work, name='hfs-worker-{}'.format(i), daemon=True)
+            for i in range(workers)
+        ]
+        for t in self.workers:
+            t.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self.park(request, client_address, None)
+
+    def park(self, request, client_address, handler):
+        keep_alive = self.RequestHandlerClass.keep_alive
+        deadline = time.monotonic() + keep_alive if keep_alive else None
+        with self.arrivals_lock:
+            self.arrivals.append((request, client_address, handler, deadline))
+        with suppress(BlockingIOError):
+            self.waker.send(b'\0')
+
+    def watch(self):
+        swept = time.monotonic()
+        while True:
+            for key, events in self.selector.select(1):
+                if key.data is None:
+                    with suppress(BlockingIOError):
+                        self.wakeup.recv(4096)
+                    continue
+
+                self.selector.unregister(key.fileobj)
+                self.pending.put(key.data[:3])
+
+            with self.arrivals_lock:
+                arrivals, self.arrivals = self.arrivals, []
+            for job in arrivals:
+                if job is None:
+                    return
+                self.selector.register(job[0], selectors.EVENT_READ, job)
+
+            now = time.monotonic()
+            if now - swept < 1:
+                continue
+
+            # Idle past the keep-alive timeout
+            swept = now
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None and key.data[3] is not None and key.data[3] < now:
+                    self.selector.unregister(key.fileobj)
+                    self.close(*key.data[:3])
+
+    def work(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+
+            request, client_address, handler = job
+            try:
+                if handler is None:
+                    handler = self.RequestHandlerClass(request, client_address, self)
+                else:
+                    handler.resume()
+
+                if not handler.close_connection:
+                    self.park(request, client_address, handler)
+                    continue
+
+            except Exception:
+                self.handle_error(request, client_address)
+
+            self.close(request, client_address, handler)
+
+    def close(self, request, client_address, handler):
+        if handler is not None:
+            handler.close()
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        with self.arrivals_lock:
+            self.arrivals.append(None)
+        with suppress(BlockingIOError):
+            self.waker.send(b'\0')
+        for t in self.workers:
+            self.pending.put(None)
+
+
+class ThreadPoolServer(bottle.ServerAdapter):
+    def run(self, app):
+        workers = self.options.get('workers', 16)
+        queue_size = self.options.get('queue_size', 64)
+
+        class handler_cls(RequestHandler):
+            quiet = self.quiet
+            keep_alive = self.options.get('keep_alive', RequestHandler.keep_alive)
+            max_requests = self.options.get('max_requests', RequestHandler.max_requests)
+
+        class server_cls(ThreadPoolWSGIServer):
+            address_family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+            reuse_port = self.options.get('reuse_port', False)
+
+        self.srv = server_cls((self.host, self.port), handler_cls, workers, queue_size)
+        self.srv.set_app(app)
+        self.port = self.srv.server_port
+        try:
+            self.srv.serve_forever()
+        except KeyboardInterrupt:
+            self.srv.server_close()
+            raise
+
+
+class BadRequest(Exception):
+    pass
+
+
+class StreamBody:
+    # wsgi.input of the asyncio server: the app reads it on a worker thread,
+    # while the data comes off the connection on the event loop. A chunked
+    # body is passed on as it is, read up to the end of the connection
+    def __init__(self, loop, reader, writer, length, expect_continue):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.unfetched = length
+        self.expect_continue = expect_continue
+        self.buf = b''
+
+    async def fetch(self, size):
+        # Only a body the app wants is asked for
+        if self.expect_continue:
+            self.expect_continue = False
+            self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        return await self.reader.read(size)
+
+    def read(self, size=-1):
+        if size < 0:
+            return b''.join(iter(lambda: self.read(1 << 20), b''))
+
+        if not self.buf and self.unfetched != 0:
+            count = max(size, 1 << 16)
+            if self.unfetched is not None:
+                count = min(count, self.unfetched)
+
+            self.buf = asyncio.run_coroutine_threadsafe(self.fetch(count), self.loop).result()
+            if self.unfetched is not None:
+                self.unfetched = self.unfetched - len(self.buf) if self.buf else 0
+
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        line = b''
+        while not line.endswith(b'\n') and (size < 0 or len(line) < size):
+            c = self.read(1)
+            if not c:
+                break
+            line += c
+
+        return line
+
+    async def drain(self, limit):
+        # Skip what the app left unread, so the next request starts at its request line
+        if self.unfetched is None or self.unfetched > limit:
+            return False
+
+        if self.unfetched and not self.expect_continue:
+            await self.reader.readexactly(self.unfetched)
+            self.unfetched = 0
+
+        return not self.unfetched
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    # The connections are handled on one event loop, the app runs on a pool
+    # of worker threads, so that a slow request does not hold up the others
+    def run(self, app):
+        self.app = app
+        self.pool = ThreadPoolExecutor(self.options.get('workers', 16), thread_name_prefix='hfs-app')
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        srv = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            reuse_port=self.options.get('reuse_port', False),
+        )
+        self.port = srv.sockets[0].getsockname()[1]
+        async with srv:
+            await srv.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        max_requests = self.options.get('max_requests', RequestHandler.max_requests)
+        try:
+            served = 1
+            while await self.handle_request(reader, writer, peer, served >= max_requests):
+                served += 1
+
+        except BadRequest as e:
+            writer.write(
+                'HTTP/1.1 {}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'.format(e).encode('latin-1')
+            )
+            with suppress(ConnectionError):
+                await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        except Exception:
+            traceback.print_exc()
+
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer, peer, last):
+        keep_alive_timeout = self.options.get('keep_alive', RequestHandler.keep_alive)
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b'\r\n\r\n'),
+                keep_alive_timeout or None,
+            )
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        except asyncio.LimitOverrunError:
+            raise BadRequest('431 Request Header Fields Too Large')
+
+        lines = head.decode('latin-1').lstrip('\r\n').split('\r\n')
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            raise BadRequest('400 Bad Request')
+
+        if not version.startswith('HTTP/1.'):
+            raise BadRequest('505 HTTP Version Not Supported')
+
+        environ = self.make_environ(method, target, version, lines[1:], peer)
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if last or not keep_alive_timeout:
+            keep_alive = False
+        elif version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+
+        loop = asyncio.get_running_loop()
+        expect_continue = environ.get('HTTP_EXPECT', '').lower() == '100-continue' and version == 'HTTP/1.1'
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # The app may stop reading anywhere inside the chunks
+            body = StreamBody(loop, reader, writer, None, expect_continue)
+            keep_alive = False
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise BadRequest('400 Bad Request')
+
+            if length < 0:
+                raise BadRequest('400 Bad Request')
+
+            body = StreamBody(loop, reader, writer, length, expect_continue)
+
+        environ['wsgi.input'] = body
+
+        status, sent, keep_alive, sendfile = await loop.run_in_executor(
+            self.pool, self.respond, loop, writer, method, version, environ, keep_alive, keep_alive_timeout,
+        )
+        if sendfile:
+            result, span = sendfile
+            try:
+                await writer.drain()
+                sent = await loop.sendfile(writer.transport, *span)
+            finally:
+                result.close()
+
+        if not self.quiet:
+            sys.stderr.write('{} - - [{}] "{}" {} {}\n'.format(
+                peer[0], time.strftime('%d/%b/%Y %H:%M:%S'),
+                lines[0], status.split()[0], sent,
+            ))
+
+        return keep_alive
+
+    def make_environ(self, method, target, version, header_lines, peer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'SERVER_SOFTWARE': SERVER_SOFTWARE,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.options.get('reuse_port', False),
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+
+        for line in header_lines:
+            if not line:
+                continue
+
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest('400 Bad Request')
+
+            key = name.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+
+            value = value.strip()
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+
+        return environ
+
+    def respond(self, loop, writer, method, version, environ, keep_alive, keep_alive_timeout):
+        # On a worker thread: bottle keeps the request in thread locals, also
+        # while the body is produced, so the app is called and its body
+        # iterated here. The writes go to the event loop. A file that can
+        # be sent with sendfile goes back to the loop as it is
+        def call(coro):
+            return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+        response = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+
+        result = self.app(environ, start_response)
+        sendfile = None
+        try:
+            if keep_alive:
+                # A body that does not arrive in time ends the connection
+                try:
+                    keep_alive = call(asyncio.wait_for(
+                        environ['wsgi.input'].drain(bottle.BaseRequest.MEMFILE_MAX),
+                        keep_alive_timeout,
+                    ))
+                except asyncio.TimeoutError:
+                    keep_alive = False
+
+            status, headers = response
+            head, has_body, chunked, keep_alive, content_length = self.make_head(
+                method, version, status, headers, keep_alive,
+            )
+            if has_body and isinstance(result, FileWrapper):
+                span = result.span(content_length)
+                if span:
+                    sendfile = result, span
+                    call(self.write(writer, head))
+                    return status, 0, keep_alive, sendfile
+
+            call(self.write(writer, head))
+            sent = 0
+            if has_body:
+                for data in result:
+                    if not data:
+                        continue
+
+                    sent += len(data)
+                    if chunked:
+                        data = b'%x\r\n%s\r\n' % (len(data), data)
+                    call(self.write(writer, data))
+
+                if chunked:
+                    call(self.write(writer, b'0\r\n\r\n'))
+
+            return status, sent, keep_alive, None
+
+        finally:
+            if sendfile is None and hasattr(result, 'close'):
+                result.close()
+
+    async def write(self, writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    def make_head(self, method, version, status, headers, keep_alive):
+        headers = list(headers)
+        names = {name.lower() for name, value in headers}
+        code = int(status.split()[0])
+        has_body = method != 'HEAD' and code not in (204, 304) and code >= 200
+
+        chunked = False
+        if has_body and 'content-length' not in names:
+            if version == 'HTTP/1.1':
+                chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep_alive = False
+
+        if 'date' not in names:
+            headers.append(('Date', email.utils.formatdate(usegmt=True)))
+        if 'server' not in names:
+            headers.append(('Server', SERVER_SOFTWARE))
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+        head = '{} {}\r\n{}\r\n'.format(
+            version, status,
+            ''.join('{}: {}\r\n'.format(name, value) for name, value in headers),
+        ).encode('latin-1')
+        content_length = next((v for k, v in headers if k.lower() == 'content-length'), None)
+        return head, has_body, chunked, keep_alive, content_length
+
+
+engines = {
+    'thread': ThreadPoolServer,
+    'asyncio': AsyncioServer,
+}
+
+
+def prefork(processes, run):
+    workers = {}
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            workers[pid] = time.monotonic()
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = 1
+        try:
+            run()
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    for i in range(processes):
+        spawn()
+
+    try:
+        while workers:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = 'killed by signal {}'.format(os.WTERMSIG(status))
+            else:
+                reason = 'exited with status {}'.format(os.WEXITSTATUS(status))
+
+            print('*** Worker {} {}, restarting ***'.format(pid, reason), file=sys.stderr)
+
+            # Do not spin if workers die right after starting, e.g. port in use
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+
+            spawn()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for pid in workers:
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+        for pid in workers:
+            with suppress(ChildProcessError):
+                os.waitpid(pid, 0)
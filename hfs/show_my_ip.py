@@ -1,7 +1,7 @@
 import os
 import socket
 import sys
-import importlib
+import importlib.util
 
 def import_netifaces_module():
     v = os.environ.get('VIRTUAL_ENV', None)
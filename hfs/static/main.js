@@ -18,21 +18,19 @@ $(function () {
     qrcode.clear();
     qrcode.makeCode(decodeURIComponent(window.location));
 
-    $('.widget-show').click(function () {
+    /* Delegated, the listing is replaced after uploads */
+    $(document).on('click', '.widget-show', function () {
         $('#widget-show-hidden-files').addClass('hidden');
         $('#hidden-files').removeClass('hidden');
-        console.log('test');
     });
 
-    $('.widget-hide').click(function () {
+    $(document).on('click', '.widget-hide', function () {
         $('#widget-show-hidden-files').removeClass('hidden');
         $('#hidden-files').addClass('hidden');
     });
 
     $('#file').change(on_file_selected);
-    $('#btn-upload').click(function () {
-        upload_file(0);
-    });
+    $('#btn-upload').click(upload_files);
 
 });
 
@@ -86,66 +84,356 @@ function on_file_selected () {
 }
 
 
-function show_upload_progress (metadata_obj, evt) {
-    if (evt.lengthComputable) {
-        var percent = Math.round(evt.loaded * 100 / evt.total);
-        metadata_obj.progress_bar.css('width', percent +'%');
-        metadata_obj.progress_ratio.text(evt.loaded +'/'+ evt.total);
-    } else {
-        metadata_obj.progress_bar.css({
-            'width': '100%',
-            'background': 'yellow',
-        });
-        metadata_obj.progress_ratio.text(evt.loaded +'/?');
+/* Files are sent as resumable uploads: an upload is created with POST, its
+ * URL kept in localStorage, and the data sent with PATCH from the offset the
+ * server has. A broken connection is retried from where it stopped, also
+ * after the page is reloaded and the same file is selected again. Files
+ * bigger than CHUNK_SIZE are sent in parts at once, which the server
+ * writes in place into one upload */
+var UPLOAD_PARALLEL = 4;                /* requests at once */
+var CHUNK_SIZE = 32 * 1024 * 1024;
+var RETRY_DELAYS = [1, 2, 5, 10, 30];
+
+var upload_queue = [];
+var uploads_running = 0;
+var files_left = 0;
+var files_failed = 0;
+
+
+function upload_files () {
+    for (var i = 0; i < metadata.length; i++) {
+        var metadata_obj = metadata[i];
+        if (metadata_obj.started) {
+            continue;
+        }
+        metadata_obj.started = true;
+        metadata_obj.failed = false;
+        metadata_obj.tasks = split_upload(metadata_obj);
+        metadata_obj.parts_left = metadata_obj.tasks.length;
+        files_left++;
+        if (metadata_obj.tasks[0].partial) {
+            start_parts(metadata_obj);
+        } else {
+            upload_queue.push.apply(upload_queue, metadata_obj.tasks);
+        }
     }
+    pump_uploads();
 }
 
 
-function show_upload_complete_message (index) {
-    $('#message').text('Upload succeed.');
-    if (index == metadata.length - 1) {
-        window.location.reload();
+/* The upload the parts write to is created first, or resumed */
+function start_parts (metadata_obj) {
+    var key = file_key(metadata_obj) +':parts';
+    var url = localStorage.getItem(key);
+    var req = new XMLHttpRequest();
+
+    req.addEventListener('load', function () {
+        if (url && req.status == 404) {
+            localStorage.removeItem(key);
+            metadata_obj.tasks.forEach(function (task) {
+                localStorage.removeItem(upload_key(task));
+            });
+            start_parts(metadata_obj);
+            return;
+        }
+        if (req.status != 200 && req.status != 201) {
+            metadata_obj.failed = true;
+            file_finished(metadata_obj);
+            return;
+        }
+        if (!url) {
+            url = req.getResponseHeader('Location');
+            localStorage.setItem(key, url);
+        }
+        metadata_obj.parts_url = url;
+        upload_queue.push.apply(upload_queue, metadata_obj.tasks);
+        pump_uploads();
+    }, false);
+    req.addEventListener('error', function () {
+        metadata_obj.failed = true;
+        file_finished(metadata_obj);
+    }, false);
+    if (url) {
+        req.open('HEAD', url, true);
     } else {
-        upload_file(index + 1);
+        req.open('POST', metadata_obj.form.attr('action'), true);
+        req.setRequestHeader('Upload-Length', metadata_obj.file.size);
+        req.setRequestHeader('Upload-Concat', 'final');
+        req.setRequestHeader('Upload-Name', encodeURIComponent(metadata_obj.file.name));
     }
+    req.send();
 }
 
 
-function show_upload_fail_message () {
-    $('#message').text('Upload failed.');
+function split_upload (metadata_obj) {
+    var size = metadata_obj.file.size;
+    var partial = size > CHUNK_SIZE;
+    var tasks = [];
+    var start = 0;
+    do {
+        tasks.push({
+            metadata_obj: metadata_obj,
+            start: start,
+            end: partial ? Math.min(start + CHUNK_SIZE, size) : size,
+            partial: partial,
+            loaded: 0,
+            retries: 0,
+            url: null,
+        });
+        start += CHUNK_SIZE;
+    } while (partial && start < size);
+    return tasks;
 }
 
 
-function show_upload_cancel_message () {
-    $('#message').text('Upload canceled.');
+function pump_uploads () {
+    while (uploads_running < UPLOAD_PARALLEL && upload_queue.length) {
+        var task = upload_queue.shift();
+        if (task.metadata_obj.failed) {
+            continue;
+        }
+        uploads_running++;
+        var url = localStorage.getItem(upload_key(task));
+        if (url) {
+            resume_upload(task, url);
+        } else {
+            create_upload(task);
+        }
+    }
 }
 
 
-function upload_file (index) {
-    if (index >= metadata.length) {
-        return;
+function file_key (metadata_obj) {
+    var file = metadata_obj.file;
+    return ['hfs-upload', $('#curdir').val(), file.name, file.size, file.lastModified].join(':');
+}
+
+
+function upload_key (task) {
+    return [file_key(task.metadata_obj), task.start, task.end].join(':');
+}
+
+
+function show_upload_progress (metadata_obj) {
+    var loaded = 0;
+    for (var i = 0; i < metadata_obj.tasks.length; i++) {
+        loaded += metadata_obj.tasks[i].loaded;
     }
-    var metadata_obj = metadata[index];
+    var total = metadata_obj.file.size;
+    var percent = total ? Math.round(loaded * 100 / total) : 100;
+    metadata_obj.progress_bar.css('width', percent +'%');
+    metadata_obj.progress_ratio.text(loaded +'/'+ total);
+
+    var all_loaded = 0;
+    var all_total = 0;
+    for (var j = 0; j < metadata.length; j++) {
+        var tasks = metadata[j].tasks || [];
+        for (var k = 0; k < tasks.length; k++) {
+            all_loaded += tasks[k].loaded;
+            all_total += tasks[k].end - tasks[k].start;
+        }
+    }
+    $('#message').text('Uploading: '+ all_loaded +'/'+ all_total);
+}
+
+
+function create_upload (task) {
+    var metadata_obj = task.metadata_obj;
     var req = new XMLHttpRequest();
-    var form = new FormData();
-    var method = metadata_obj.form.attr('method');
-    var url = metadata_obj.form.attr('action');
 
-    form.append('upload', metadata_obj.file);
+    req.addEventListener('load', function () {
+        if (req.status != 201) {
+            upload_failed(task);
+            return;
+        }
+        var url = req.getResponseHeader('Location');
+        if (task.end == task.start) {
+            upload_done(task, url);
+            return;
+        }
+        localStorage.setItem(upload_key(task), url);
+        send_upload(task, url, 0);
+    }, false);
+    req.addEventListener('error', function () {
+        retry_upload(task, null);
+    }, false);
+    req.open('POST', metadata_obj.form.attr('action'), true);
+    req.setRequestHeader('Upload-Length', task.end - task.start);
+    if (task.partial) {
+        req.setRequestHeader('Upload-Concat', 'partial;'+ metadata_obj.parts_url);
+        req.setRequestHeader('Upload-Start', task.start);
+    } else {
+        req.setRequestHeader('Upload-Name', encodeURIComponent(metadata_obj.file.name));
+    }
+    req.send();
+}
+
+
+function resume_upload (task, url) {
+    var req = new XMLHttpRequest();
+
+    req.addEventListener('load', function () {
+        if (req.status == 200) {
+            send_upload(task, url, parseInt(req.getResponseHeader('Upload-Offset')));
+        } else if (req.status == 404) {
+            localStorage.removeItem(upload_key(task));
+            create_upload(task);
+        } else {
+            retry_upload(task, url);
+        }
+    }, false);
+    req.addEventListener('error', function () {
+        retry_upload(task, url);
+    }, false);
+    req.open('HEAD', url, true);
+    req.send();
+}
+
 
+function send_upload (task, url, offset) {
+    var metadata_obj = task.metadata_obj;
+    var length = task.end - task.start;
+    var req = new XMLHttpRequest();
 
+    task.loaded = offset;
+    show_upload_progress(metadata_obj);
     req.upload.addEventListener('progress', function (evt) {
-        show_upload_progress(metadata_obj, evt);
+        task.retries = 0;
+        task.loaded = offset + evt.loaded;
+        show_upload_progress(metadata_obj);
     }, false);
     req.addEventListener('load', function () {
-        show_upload_complete_message(index);
+        if (req.status == 204 && parseInt(req.getResponseHeader('Upload-Offset')) == length) {
+            upload_done(task, url);
+        } else if (req.status == 204 || req.status == 409) {
+            resume_upload(task, url);
+        } else if (req.status == 404) {
+            localStorage.removeItem(upload_key(task));
+            create_upload(task);
+        } else {
+            upload_failed(task);
+        }
+    }, false);
+    req.addEventListener('error', function () {
+        retry_upload(task, url);
     }, false);
-    req.addEventListener('error', show_upload_fail_message, false);
-    // req.addEventListener('abort', show_upload_cancel_message, false);
-    req.open(method, url, true);
-    req.send(form);
+    req.open('PATCH', url, true);
+    req.setRequestHeader('Upload-Offset', offset);
+    req.setRequestHeader('Content-Type', 'application/offset+octet-stream');
+    req.send(metadata_obj.file.slice(task.start + offset, task.end));
+}
+
+
+function retry_upload (task, url) {
+    if (task.retries >= RETRY_DELAYS.length) {
+        upload_failed(task);
+        return;
+    }
+    var delay = RETRY_DELAYS[task.retries++];
+    $('#message').text('Connection lost, retrying in '+ delay +' s...');
+    setTimeout(function () {
+        if (url) {
+            resume_upload(task, url);
+        } else {
+            create_upload(task);
+        }
+    }, delay * 1000);
 }
 
+
+function upload_done (task, url) {
+    var metadata_obj = task.metadata_obj;
+    uploads_running--;
+    task.url = url;
+    task.loaded = task.end - task.start;
+    if (!task.partial) {
+        localStorage.removeItem(upload_key(task));
+    }
+    if (--metadata_obj.parts_left == 0 && !metadata_obj.failed) {
+        if (task.partial) {
+            concat_upload(metadata_obj);
+        } else {
+            show_upload_progress(metadata_obj);
+            file_finished(metadata_obj);
+        }
+    }
+    pump_uploads();
+}
+
+
+function upload_failed (task) {
+    uploads_running--;
+    if (!task.metadata_obj.failed) {
+        task.metadata_obj.failed = true;
+        file_finished(task.metadata_obj);
+    }
+    pump_uploads();
+}
+
+
+function concat_upload (metadata_obj) {
+    var req = new XMLHttpRequest();
+    var urls = metadata_obj.tasks.map(function (task) {
+        return task.url;
+    });
+
+    req.addEventListener('load', function () {
+        if (req.status != 201) {
+            metadata_obj.failed = true;
+        } else {
+            metadata_obj.tasks.forEach(function (task) {
+                localStorage.removeItem(upload_key(task));
+            });
+            localStorage.removeItem(file_key(metadata_obj) +':parts');
+            show_upload_progress(metadata_obj);
+        }
+        file_finished(metadata_obj);
+    }, false);
+    req.addEventListener('error', function () {
+        metadata_obj.failed = true;
+        file_finished(metadata_obj);
+    }, false);
+    req.open('POST', metadata_obj.form.attr('action'), true);
+    req.setRequestHeader('Upload-Concat', 'final;'+ urls.join(' '));
+    req.send();
+}
+
+
+function file_finished (metadata_obj) {
+    if (metadata_obj.failed) {
+        files_failed++;
+        metadata_obj.progress_bar.css('background', 'red');
+    }
+    if (--files_left > 0) {
+        return;
+    }
+
+    /* Failed files stay to be tried again with the next click */
+    var count = metadata.length;
+    metadata = metadata.filter(function (obj) {
+        if (obj.failed) {
+            obj.started = false;
+            return true;
+        }
+        obj.form.closest('tr').remove();
+        return false;
+    });
+    $('#message').text(files_failed ?
+        'Upload failed: '+ files_failed +' of '+ count +' files.' : 'Upload succeed.');
+    files_failed = 0;
+    refresh_listing();
+}
+
+
+function refresh_listing () {
+    if ($('#virtual-list').length) {
+        reload_virtual_listing();
+    } else {
+        $('#file-browser').load(window.location.href +' #file-browser > *');
+    }
+}
+
+
 function file_delete (path) {
     var req = new XMLHttpRequest();
     req.open('DELETE', path, true);
@@ -0,0 +1,273 @@
+/* ?virtual: the listing is fetched as ?columns in pages, kept in typed
+ * arrays, and only the rows in sight are in the DOM */
+
+var ROW_HEIGHT = 28;
+var PAGE_SIZE = 5000;
+var OVERSCAN = 10;
+
+var FLAG_DIR = 1;
+var FLAG_HIDDEN = 2;
+var FLAG_DELETABLE = 4;
+
+var listing = {
+    count: 0,
+    names: [],
+    lower_names: [],
+    flags: new Uint8Array(1024),
+    sizes: new Float64Array(1024),
+    mtimes: new Float64Array(1024),
+};
+
+var sorted = new Uint32Array(0);    /* every entry, in display order */
+var view = new Uint32Array(0);      /* the entries shown, in display order */
+var show_hidden = false;
+var loading = true;
+var frame_requested = false;
+var generation = 0;                 /* bumped on reload, stale pages are dropped */
+var pending = null;                 /* the page request in flight */
+
+
+$(function () {
+    if (!$('#virtual-list').length) {
+        return;
+    }
+
+    $('.widget-show').click(function () {
+        show_hidden = true;
+        $('#widget-hide-hidden-files').removeClass('hidden');
+        filter_view();
+    });
+
+    $('.widget-hide').click(function () {
+        show_hidden = false;
+        $('#widget-hide-hidden-files').addClass('hidden');
+        filter_view();
+    });
+
+    $('#virtual-filter').on('input', filter_view);
+    $('#virtual-sort, #virtual-order').change(sort_view);
+    $('#virtual-list').scroll(request_draw);
+    $(window).resize(request_draw);
+
+    fetch_page(first_page_url());
+});
+
+
+function first_page_url () {
+    var query = window.location.search.replace(/^\?/, '').split(/[?&]/).filter(function (token) {
+        return token && token != 'virtual' && !/^(limit|cursor|sort|order)=/.test(token);
+    });
+    query.push('columns', 'limit=' + PAGE_SIZE);
+    return window.location.pathname + '?' + query.join('&');
+}
+
+
+function reload_virtual_listing () {
+    generation++;
+    if (pending) {
+        pending.abort();
+        pending = null;
+    }
+
+    listing.count = 0;
+    listing.names = [];
+    listing.lower_names = [];
+    listing.flags = new Uint8Array(1024);
+    listing.sizes = new Float64Array(1024);
+    listing.mtimes = new Float64Array(1024);
+    sorted = new Uint32Array(0);
+    view = new Uint32Array(0);
+    loading = true;
+    filter_view();
+    fetch_page(first_page_url());
+}
+
+
+function fetch_page (url) {
+    var current = generation;
+    pending = $.getJSON(url, function (data) {
+        if (current != generation) {
+            return;
+        }
+
+        pending = null;
+        append_rows(data.fields, data.rows);
+        loading = !!data.next;
+        sort_view();
+        if (data.next) {
+            fetch_page(data.next);
+        }
+    }).fail(function (req) {
+        if (current != generation) {
+            return;
+        }
+
+        pending = null;
+        loading = false;
+        $('#virtual-status').text('Listing failed: ' + req.status + ' ' + req.statusText);
+    });
+}
+
+
+function grow (needed) {
+    var capacity = listing.flags.length;
+    if (needed <= capacity) {
+        return;
+    }
+
+    while (capacity < needed) {
+        capacity *= 2;
+    }
+
+    ['flags', 'sizes', 'mtimes'].forEach(function (column) {
+        var old = listing[column];
+        listing[column] = new old.constructor(capacity);
+        listing[column].set(old);
+    });
+}
+
+
+function append_rows (fields, rows) {
+    var name = fields.indexOf('name');
+    var dir = fields.indexOf('dir');
+    var size = fields.indexOf('size');
+    var mtime = fields.indexOf('mtime');
+    var deletable = fields.indexOf('deletable');
+
+    grow(listing.count + rows.length);
+    for (var i = 0; i < rows.length; i++) {
+        var row = rows[i];
+        var j = listing.count++;
+        listing.names.push(row[name]);
+        listing.lower_names.push(row[name].toLowerCase());
+        listing.flags[j] = (row[dir] ? FLAG_DIR : 0) |
+            (row[name].charAt(0) == '.' ? FLAG_HIDDEN : 0) |
+            (row[deletable] ? FLAG_DELETABLE : 0);
+        listing.sizes[j] = row[size];
+        listing.mtimes[j] = row[mtime];
+    }
+}
+
+
+function sort_view () {
+    /* Pages come in the server order, by name with directories first, so
+     * the index of an entry is its rank by name and no names are compared */
+    var flags = listing.flags;
+    var values = {size: listing.sizes, mtime: listing.mtimes}[$('#virtual-sort').val()];
+    var sign = $('#virtual-order').val() == 'desc' ? -1 : 1;
+
+    sorted = new Uint32Array(listing.count);
+    for (var i = 0; i < sorted.length; i++) {
+        sorted[i] = i;
+    }
+
+    if (values || sign < 0) {
+        sorted.sort(function (a, b) {
+            var dirs = (flags[b] & FLAG_DIR) - (flags[a] & FLAG_DIR);
+            if (dirs) {
+                return dirs;
+            }
+
+            if (values && values[a] != values[b]) {
+                return sign * (values[a] - values[b]);
+            }
+
+            return (values ? 1 : sign) * (a - b);
+        });
+    }
+
+    filter_view();
+}
+
+
+function filter_view () {
+    var pattern = $('#virtual-filter').val().toLowerCase();
+    var lower_names = listing.lower_names;
+    var flags = listing.flags;
+    var shown = new Uint32Array(sorted.length);
+    var count = 0;
+
+    for (var i = 0; i < sorted.length; i++) {
+        var j = sorted[i];
+        if (!show_hidden && flags[j] & FLAG_HIDDEN) {
+            continue;
+        }
+
+        if (pattern && lower_names[j].indexOf(pattern) < 0) {
+            continue;
+        }
+
+        shown[count++] = j;
+    }
+
+    view = shown.subarray(0, count);
+    $('#virtual-rows').css('height', (count * ROW_HEIGHT) + 'px');
+    $('#virtual-status').text(
+        count + ' of ' + listing.count + ' entries' + (loading ? ', loading...' : '')
+    );
+    request_draw();
+}
+
+
+function request_draw () {
+    if (frame_requested) {
+        return;
+    }
+
+    frame_requested = true;
+    window.requestAnimationFrame(function () {
+        frame_requested = false;
+        draw();
+    });
+}
+
+
+function draw () {
+    var list = $('#virtual-list');
+    var first = Math.max(0, Math.floor(list.scrollTop() / ROW_HEIGHT) - OVERSCAN);
+    var last = Math.min(view.length, first + Math.ceil(list.height() / ROW_HEIGHT) + 2 * OVERSCAN);
+    var curdir = $('#curdir').val();
+    var rows = [];
+
+    for (var i = first; i < last; i++) {
+        rows.push(make_row(view[i], i * ROW_HEIGHT, curdir));
+    }
+
+    $('#virtual-rows').empty().append(rows);
+}
+
+
+function make_row (j, top, curdir) {
+    var name = listing.names[j];
+    var flags = listing.flags[j];
+    var path = '/' + curdir + '/' + encodeURIComponent(name);
+
+    var row = $('<div class="fitem">').css('top', top + 'px');
+    var cell_delete = $('<span class="col-delete">');
+    if (flags & FLAG_DELETABLE) {
+        var button = $('<button class="deletion">Delete</button>');
+        button.click(function () {
+            file_delete(path);
+        });
+        cell_delete.append(button);
+    }
+
+    row.append(cell_delete);
+    row.append($('<span class="col-mtime">').text(format_mtime(listing.mtimes[j])));
+    row.append($('<span class="col-size">').text(listing.sizes[j]));
+    row.append($('<span class="col-name">').append(
+        $('<a>').attr('href', path).text(name + (flags & FLAG_DIR ? '/' : ''))
+    ));
+    return row;
+}
+
+
+function format_mtime (mtime) {
+    var t = new Date(mtime * 1000);
+    function pad (n) {
+        return (n < 10 ? '0' : '') + n;
+    }
+
+    return t.getFullYear() +'/'+ pad(t.getMonth() + 1) +'/'+ pad(t.getDate()) +' '+
+        pad(t.getHours()) +':'+ pad(t.getMinutes()) +':'+ pad(t.getSeconds());
+}
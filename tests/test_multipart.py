@@ -0,0 +1,95 @@
+import unittest
+
+from hfs import multipart
+
+# Bodies fed to the parser in every chunk size, so that delimiters and
+# header blocks are split at every position
+
+BOUNDARY = b'----hfs-boundary'
+
+
+def make_body(parts, epilogue=b''):
+    # parts: [(headers, data)]
+    body = b'preamble\r\n'
+    for headers, data in parts:
+        body += b'--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + data + b'\r\n'
+
+    return body + b'--' + BOUNDARY + b'--\r\n' + epilogue
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def parse(chunks):
+    return [
+        (part.name, part.filename, b''.join(part))
+        for part in multipart.MultipartParser(chunks, BOUNDARY)
+    ]
+
+
+class MultipartTest(unittest.TestCase):
+    def test_chunk_boundaries(self):
+        # The data looks like the start of a delimiter more than once
+        data = b'a\r\n--' + BOUNDARY[:-1] + b'x\r\n\r\n--' + b'b' * 100 + b'\r\n-'
+        body = make_body([
+            (b'Content-Disposition: form-data; name="upload"; filename="a.bin"', data),
+            (b'Content-Disposition: form-data; name="upload"; filename="empty"', b''),
+            (b'Content-Disposition: form-data; name="note"', b'text'),
+        ], epilogue=b'ignored')
+        expected = [('upload', 'a.bin', data), ('upload', 'empty', b''), ('note', None, b'text')]
+        for size in range(1, len(body) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(parse(split(body, size)), expected)
+
+    def test_unread_data_is_skipped(self):
+        body = make_body([
+            (b'Content-Disposition: form-data; name="a"', b'x' * 1000),
+            (b'Content-Disposition: form-data; name="b"', b'y'),
+        ])
+        parts = multipart.MultipartParser(split(body, 7), BOUNDARY)
+        names = [part.name for part in parts]
+        self.assertEqual(names, ['a', 'b'])
+
+    def test_truncated(self):
+        body = make_body([(b'Content-Disposition: form-data; name="upload"; filename="a"', b'data' * 10)])
+        end = body.index(b'--' + BOUNDARY + b'--') + len(BOUNDARY) + 4
+        for cut in range(end):
+            with self.subTest(cut=cut):
+                with self.assertRaises(multipart.MultipartError):
+                    parse(split(body[:cut], 3))
+
+    def test_headers_too_long(self):
+        body = make_body([(b'X-Padding: ' + b'x' * 2 * multipart.MAX_HEADER, b'data')])
+        with self.assertRaises(multipart.MultipartError):
+            parse(split(body, 1024))
+
+    def test_malformed_header(self):
+        body = make_body([(b'no colon here', b'data')])
+        with self.assertRaises(multipart.MultipartError):
+            parse([body])
+
+    def test_filename_star(self):
+        cases = [
+            (b"filename=\"a.txt\"; filename*=UTF-8''%E2%82%AC%20rates.txt", '€ rates.txt'),
+            (b"filename*=iso-8859-1'en'%E9t%E9.txt", '\xe9t\xe9.txt'),
+            (b"filename*=''plain.txt", 'plain.txt'),
+            # An unknown charset keeps the plain filename
+            (b"filename=\"fallback.txt\"; filename*=x-no-such-charset''%E2%82%AC.txt", 'fallback.txt'),
+            (b'filename="quoted \\"name\\".txt"', 'quoted "name".txt'),
+        ]
+        for options, filename in cases:
+            with self.subTest(options=options):
+                body = make_body([(b'Content-Disposition: form-data; name="upload"; ' + options, b'')])
+                self.assertEqual(parse([body]), [('upload', filename, b'')])
+
+    def test_get_boundary(self):
+        self.assertEqual(multipart.get_boundary('multipart/form-data; boundary="a b"'), b'a b')
+        self.assertEqual(multipart.get_boundary('Multipart/Form-Data;boundary=xyz'), b'xyz')
+        self.assertIsNone(multipart.get_boundary('text/plain; boundary=xyz'))
+        self.assertIsNone(multipart.get_boundary('multipart/form-data'))
+        self.assertIsNone(multipart.get_boundary('multipart/form-data; boundary=' + 'x' * 71))
+
+
+if __name__ == '__main__':
+    unittest.main()
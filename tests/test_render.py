@@ -0,0 +1,91 @@
+import os
+import stat
+import time
+import unittest
+
+from hfs import core
+
+# Listings rendered from a fixed set of entries, compared byte for byte with
+# the files in golden/, which were produced by the templates render.py
+# replaced
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+ARGS = {
+    'ancestors_dlist': core.get_ancestors_dlist('a & b/<c>'),
+    'curdir': 'a & b/<c>',
+    'host': 'http://host:8000',
+    'pipe': False,
+    'next_url': '/a%20&%20b/?limit=10&cursor=x',
+    'du': False,
+    'fields': None,
+}
+
+CASES = {
+    'html': (core.iter_html_listing, {}),
+    'curl': (core.iter_curl_listing, {}),
+    'pipe': (core.iter_curl_listing, {'pipe': True}),
+    'du-html': (core.iter_html_listing, {'du': True}),
+    'du-curl': (core.iter_curl_listing, {'du': True}),
+    'last-page-html': (core.iter_html_listing, {'next_url': None}),
+    'last-page-curl': (core.iter_curl_listing, {'next_url': None}),
+}
+
+
+def make_item(fname, size, mtime, isdir=False, usage=None):
+    mode = stat.S_IFDIR | 0o755 if isdir else stat.S_IFREG | 0o644
+    fitem = core.FileItem(fname)
+    fitem._stat = os.stat_result((mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime))
+    fitem.usage = usage
+    return fitem
+
+
+def make_flist():
+    mtime = 1700000000
+    flist = [
+        make_item('.hidden', 0, mtime),
+        make_item('.hidden dir', 4096, mtime + 61, isdir=True, usage=(0, 0)),
+        make_item('dir & more', 4096, mtime + 3600, isdir=True, usage=(123456, 789)),
+        make_item('measuring', 4096, mtime + 7200, isdir=True, usage=(None, None)),
+        make_item('file <1> & "1\'s"', 1, mtime + 86400),
+        make_item('file-2.txt', 22, mtime + 86461),
+        make_item('uploaded.bin', 1234567890, mtime + 99999),
+        make_item('檔案.txt', 333, mtime - 86400),
+    ]
+    return sorted(flist, key=lambda x: x.fname)
+
+
+def render(case):
+    renderer, args = CASES[case]
+    flist = make_flist()
+    return ''.join(renderer(lambda: flist, dict(ARGS, **args)))
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        # Modification times are shown in local time
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        self.deletion_level, core.deletion_level = core.deletion_level, 1
+        self.upload_pool, core.upload_pool = core.upload_pool, {'uploaded.bin'}
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+
+        time.tzset()
+        core.deletion_level = self.deletion_level
+        core.upload_pool = self.upload_pool
+
+    def test_golden(self):
+        for case in CASES:
+            with self.subTest(case=case):
+                with open(os.path.join(GOLDEN, case + '.txt'), encoding='utf-8') as f:
+                    self.assertEqual(render(case), f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
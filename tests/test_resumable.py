@@ -0,0 +1,197 @@
+import os
+import tempfile
+import time
+import unittest
+
+from hfs import resumable
+
+# Uploads continued at an offset, expired, and sent in parts, in a
+# temporary directory
+
+
+class ResumableTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dpath = self.tmp.name
+        resumable.expired.clear()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def listdir(self):
+        return sorted(os.listdir(self.dpath))
+
+    def test_append(self):
+        upath = resumable.create(self.dpath, 'a.txt', 10)
+        self.assertEqual(resumable.get_state(upath)['offset'], 0)
+        self.assertEqual(resumable.get_state(upath)['name'], 'a.txt')
+
+        completed = []
+        complete = lambda: completed.append(resumable.get_state(upath)['offset'])
+        self.assertEqual(resumable.append(upath, 0, 10, [b'0123', b'45'], complete), 6)
+        self.assertEqual(resumable.get_state(upath)['offset'], 6)
+        self.assertEqual(completed, [])
+
+        # A retry from where the client thinks it was
+        with self.assertRaises(resumable.UploadConflict) as cm:
+            resumable.append(upath, 4, 10, [b'4567'], complete)
+        self.assertEqual(cm.exception.offset, 6)
+
+        self.assertEqual(resumable.append(upath, 6, 10, [b'6789'], complete), 10)
+        self.assertEqual(completed, [10])
+
+        fpath = os.path.join(self.dpath, 'a.txt')
+        resumable.finish(upath, fpath)
+        self.assertEqual(self.read(fpath), b'0123456789')
+        self.assertEqual(self.listdir(), ['a.txt'])
+        self.assertIsNone(resumable.get_state(upath))
+
+    def test_append_broken_off(self):
+        upath = resumable.create(self.dpath, 'a.txt', 10)
+
+        def chunks():
+            yield b'012'
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            resumable.append(upath, 0, 10, chunks(), lambda: None)
+        self.assertEqual(resumable.get_state(upath)['offset'], 3)
+
+    def test_append_too_long(self):
+        upath = resumable.create(self.dpath, 'a.txt', 4)
+        with self.assertRaises(resumable.UploadTooLong):
+            resumable.append(upath, 0, 4, [b'01', b'234'], lambda: None)
+        self.assertEqual(resumable.get_state(upath)['offset'], 2)
+
+    def test_append_busy(self):
+        upath = resumable.create(self.dpath, 'a.txt', 4)
+        with resumable.locked(upath, 'rb'):
+            with self.assertRaises(resumable.UploadConflict) as cm:
+                resumable.append(upath, 0, 4, [b'0123'], lambda: None)
+        self.assertIsNone(cm.exception.offset)
+
+    def test_get_state(self):
+        upath = resumable.create(self.dpath, 'a.txt', 4)
+        self.assertIsNone(resumable.get_state(upath + resumable.STATE))
+        self.assertIsNone(resumable.get_state(os.path.join(self.dpath, 'a.txt')))
+        self.assertIsNone(resumable.get_state(os.path.join(self.dpath, resumable.PREFIX + 'missing')))
+
+    def test_terminate(self):
+        upath = resumable.create(self.dpath, 'a.txt', 4)
+        resumable.terminate(upath)
+        self.assertEqual(self.listdir(), [])
+        with self.assertRaises(resumable.UploadGone):
+            resumable.terminate(upath)
+
+    def test_expire(self):
+        old = resumable.create(self.dpath, 'old.txt', 4)
+        new = resumable.create(self.dpath, 'new.txt', 4)
+        with open(os.path.join(self.dpath, 'kept.txt'), 'w'):
+            pass
+
+        past = time.time() - 7200
+        for path in (old, old + resumable.STATE):
+            os.utime(path, (past, past))
+
+        resumable.expire(self.dpath, 3600)
+        self.assertIsNone(resumable.get_state(old))
+        self.assertIsNotNone(resumable.get_state(new))
+        self.assertIn('kept.txt', self.listdir())
+
+        # Not looked for again within EXPIRE_INTERVAL
+        for path in (new, new + resumable.STATE):
+            os.utime(path, (past, past))
+        resumable.expire(self.dpath, 3600)
+        self.assertIsNotNone(resumable.get_state(new))
+
+    def test_expire_recent_data(self):
+        # Data written lately keeps an old state file alive
+        upath = resumable.create(self.dpath, 'a.txt', 4)
+        past = time.time() - 7200
+        os.utime(upath + resumable.STATE, (past, past))
+        resumable.expire(self.dpath, 3600)
+        self.assertIsNotNone(resumable.get_state(upath))
+
+    def make_parts(self, length, ranges):
+        target = resumable.create(self.dpath, 'a.bin', length, parts=True)
+        self.assertEqual(os.path.getsize(target), length)
+        return target, [resumable.create_part(target, start, count) for start, count in ranges]
+
+    def test_parts(self):
+        target, (first, second) = self.make_parts(8, [(0, 5), (5, 3)])
+        self.assertEqual(resumable.get_state(target)['offset'], 0)
+        self.assertEqual(resumable.get_state(first)['target'], target)
+
+        # Written out of order, the first in two requests
+        self.assertEqual(resumable.write_part(second, 0, [b'567']), 3)
+        self.assertEqual(resumable.write_part(first, 0, [b'01']), 2)
+        with self.assertRaises(resumable.UploadConflict) as cm:
+            resumable.write_part(first, 0, [b'01234'])
+        self.assertEqual(cm.exception.offset, 2)
+        self.assertEqual(resumable.write_part(first, 2, [b'2', b'34']), 5)
+
+        completed = []
+
+        def complete(upath, state):
+            completed.append((upath, state['name'], self.read(upath)))
+
+        resumable.finish_parts([first, second], complete)
+        self.assertEqual(completed, [(target, 'a.bin', b'01234567')])
+        self.assertIsNone(resumable.get_state(first))
+        self.assertIsNone(resumable.get_state(second))
+
+        # The upload is finished by one request, the others find it gone
+        with self.assertRaises(resumable.UploadGone):
+            resumable.finish_parts([first, second], complete)
+
+    def test_part_too_long(self):
+        target, (part,) = self.make_parts(4, [(0, 4)])
+        with self.assertRaises(resumable.UploadTooLong):
+            resumable.write_part(part, 0, [b'01', b'234'])
+        self.assertEqual(resumable.get_state(part)['offset'], 2)
+
+    def test_finish_parts_order(self):
+        target, (first, second) = self.make_parts(8, [(0, 5), (5, 3)])
+        resumable.write_part(first, 0, [b'01234'])
+        resumable.write_part(second, 0, [b'567'])
+        with self.assertRaises(resumable.InvalidParts):
+            resumable.finish_parts([second, first], lambda upath, state: None)
+        self.assertIsNotNone(resumable.get_state(first))
+
+    def test_finish_parts_missing(self):
+        target, (first, second) = self.make_parts(8, [(0, 5), (5, 3)])
+        resumable.write_part(first, 0, [b'01234'])
+        with self.assertRaises(resumable.InvalidParts):
+            resumable.finish_parts([first], lambda upath, state: None)
+
+    def test_finish_parts_incomplete(self):
+        target, (first, second) = self.make_parts(8, [(0, 5), (5, 3)])
+        resumable.write_part(first, 0, [b'01234'])
+        resumable.write_part(second, 0, [b'5'])
+        with self.assertRaises(resumable.UploadConflict) as cm:
+            resumable.finish_parts([first, second], lambda upath, state: None)
+        self.assertEqual(cm.exception.offset, 1)
+
+    def test_finish_parts_of_other_upload(self):
+        target, (first, second) = self.make_parts(8, [(0, 5), (5, 3)])
+        other, (stray,) = self.make_parts(3, [(0, 3)])
+        resumable.write_part(first, 0, [b'01234'])
+        resumable.write_part(stray, 0, [b'567'])
+        with self.assertRaises(resumable.InvalidParts):
+            resumable.finish_parts([first, stray], lambda upath, state: None)
+
+    def test_terminated_target(self):
+        target, (part,) = self.make_parts(4, [(0, 4)])
+        resumable.terminate(target)
+        with self.assertRaises(resumable.UploadGone):
+            resumable.write_part(part, 0, [b'0123'])
+        with self.assertRaises(resumable.UploadGone):
+            resumable.finish_parts([part], lambda upath, state: None)
+
+
+if __name__ == '__main__':
+    unittest.main()